@@ -32,35 +32,24 @@ out_path = 'merged/'
 
 from PIL import Image
 import os 
+import sys
 import math
 import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from composite import composite_u8
 
 def composite4(fg, bg, a, w, h):
     
-    bbox = fg.getbbox()
     bg = bg.crop((0,0,w,h))
     
-    fg_list = fg.load()
-    bg_list = bg.load()
-    a_list = a.load()
+    fg = np.asarray(fg)[:, :, :3]
+    bg = np.asarray(bg)
+    a = np.asarray(a.convert('L'))
     
-    for y in range(h):
-        for x in range (w):
-            alpha = a_list[x,y] / 255
-            t = fg_list[x,y][0]
-            t2 = bg_list[x,y][0]
-            if alpha >= 1:
-                r = int(fg_list[x,y][0])
-                g = int(fg_list[x,y][1])
-                b = int(fg_list[x,y][2])
-                bg_list[x,y] = (r, g, b, 255)
-            elif alpha > 0:
-                r = int(alpha * fg_list[x,y][0] + (1-alpha) * bg_list[x,y][0])
-                g = int(alpha * fg_list[x,y][1] + (1-alpha) * bg_list[x,y][1])
-                b = int(alpha * fg_list[x,y][2] + (1-alpha) * bg_list[x,y][2])
-                bg_list[x,y] = (r, g, b, 255)
-
-    return bg
+    # uint8 fixed-point blend, same truncation as int(alpha * fg + (1-alpha) * bg)
+    return Image.fromarray(composite_u8(fg, bg, a), 'RGB')
 
 num_bgs = 20
 
@@ -1,12 +1,16 @@
 import math
+import os
 import time
-from multiprocessing import Pool
+from functools import partial
+from multiprocessing import Pool, cpu_count
 
 import cv2 as cv
 import numpy as np
 import tqdm
 from tqdm import tqdm
 
+from composite import composite_u8, workspace
+
 ##############################################################
 # Set your paths here
 
@@ -33,18 +37,27 @@ with open('Combined_Dataset/Test_set/test_fg_names.txt') as f:
 ##############################################################
 
 def composite4(fg, bg, a, w, h):
-    fg = np.array(fg, np.float32)
-    bg = np.array(bg[0:h, 0:w], np.float32)
-    alpha = np.zeros((h, w, 1), np.float32)
-    alpha[:, :, 0] = a / 255.
-    comp = alpha * fg + (1 - alpha) * bg
-    comp = comp.astype(np.uint8)
-    return comp
+    # the result lives in the shared workspace until the next call; it is written out right away
+    out = workspace.get('comp', (h, w, 3), np.uint8)
+    return composite_u8(fg, bg[0:h, 0:w], a, out)
 
 
-def process(im_name, bg_name, fcount, bcount):
-    im = cv.imread(fg_path + im_name)
-    a = cv.imread(a_path + im_name, 0)
+def output_filename(im_name, bg_name, fcount, bcount, ext='.png'):
+    return out_path + bg_name.split('.')[0] + '!' + im_name.split('.')[0] + '!' + str(fcount) + '!' + str(bcount) + ext
+
+
+def write_output(filename, out, png_compression=1):
+    # write under a temporary name first so an interrupted run never leaves a truncated output behind
+    root, ext = os.path.splitext(filename)
+    tmp_filename = root + '.part' + ext
+    if ext == '.npy':
+        np.save(tmp_filename, out)
+    else:
+        cv.imwrite(tmp_filename, out, [cv.IMWRITE_PNG_COMPRESSION, png_compression])
+    os.replace(tmp_filename, filename)
+
+
+def composite_bg(im, a, bg_name):
     h, w = im.shape[:2]
     bg = cv.imread(bg_path + bg_name)
     bh, bw = bg.shape[:2]
@@ -54,45 +67,62 @@ def process(im_name, bg_name, fcount, bcount):
     if ratio > 1:
         bg = cv.resize(src=bg, dsize=(math.ceil(bw * ratio), math.ceil(bh * ratio)), interpolation=cv.INTER_CUBIC)
 
-    out = composite4(im, bg, a, w, h)
-    filename = out_path  + bg_name.split('.')[0]+'!'+im_name.split('.')[0]+'!'+ str(fcount) + '!' + str(bcount) + '.png'
-    cv.imwrite(filename, out)
+    return composite4(im, bg, a, w, h)
 
 
-def process_one_fg(fcount):
-    im_name = fg_files[fcount]
-    bcount = fcount * num_bgs
+def process(im_name, bg_name, fcount, bcount, ext='.png', png_compression=1):
+    im = cv.imread(fg_path + im_name)
+    a = cv.imread(a_path + im_name, 0)
+    out = composite_bg(im, a, bg_name)
+    write_output(output_filename(im_name, bg_name, fcount, bcount, ext), out, png_compression)
 
-    for i in range(num_bgs):
+
+def process_one_fg(fcount, ext='.png', png_compression=1, overwrite=False):
+    """
+    Composites every background paired with one foreground, skipping outputs that
+    already exist. The foreground and its alpha are decoded once per shard.
+    Returns the number of images written.
+    """
+    im_name = fg_files[fcount]
+    pending = []
+    for bcount in range(fcount * num_bgs, (fcount + 1) * num_bgs):
         bg_name = bg_files[bcount]
-        process(im_name, bg_name, fcount, bcount)
-        bcount += 1
+        filename = output_filename(im_name, bg_name, fcount, bcount, ext)
+        if overwrite or not os.path.exists(filename):
+            pending.append((bg_name, filename))
+    if not pending:
+        return 0
+
+    im = cv.imread(fg_path + im_name)
+    a = cv.imread(a_path + im_name, 0)
+    for bg_name, filename in pending:
+        write_output(filename, composite_bg(im, a, bg_name), png_compression)
+    return len(pending)
 
 
-def do_composite_test():
-    print('Doing composite training data...')
+def do_composite_test(processes=None, ext='.png', png_compression=1, overwrite=False):
+    """
+    Composites the dataset with one task per foreground on a process pool.
+    Outputs that already exist are kept, so an interrupted run can simply be restarted.
+    :param ext: '.png' (written with `png_compression`, 0-9) or '.npy' for raw uint8 arrays
+    """
+    print('Doing composite test data...')
 
-    # a_files = os.listdir(a_path)
     num_samples = len(fg_files) * num_bgs
     print('num_samples: ' + str(num_samples))
 
     start = time.time()
-    # bcount = 0
-    # for fcount in tqdm(range(len(fg_files))):
-    #     im_name = fg_files[fcount]
-    #
-    #     for i in range(num_bgs):
-    #         bg_name = bg_files[bcount]
-    #         process(im_name, bg_name, fcount, bcount)
-    #         bcount += 1
-
-    with Pool(processes=16) as p:
+    written = 0
+    worker = partial(process_one_fg, ext=ext, png_compression=png_compression, overwrite=overwrite)
+    with Pool(processes=processes or cpu_count()) as p:
         max_ = len(fg_files)
         print('num_fg_files: ' + str(max_))
         with tqdm(total=max_) as pbar:
-            for i, _ in tqdm(enumerate(p.imap_unordered(process_one_fg, range(0, max_)))):
+            for count in p.imap_unordered(worker, range(0, max_)):
+                written += count
                 pbar.update()
 
     end = time.time()
     elapsed = end - start
+    print('written: {}, skipped: {}'.format(written, num_samples - written))
     print('elapsed: {} seconds'.format(elapsed))
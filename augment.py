@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# ImageNet statistics, same values as transforms.Normalize in data.py / data_human.py
+mean = [0.485, 0.456, 0.406]
+std = [0.229, 0.224, 0.225]
+
+
+def _grayscale(img):
+    r, g, b = img.unbind(1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1 - ratio) * img2).clamp_(0, 1)
+
+
+def adjust_brightness(img, factor):
+    return (img * factor).clamp_(0, 1)
+
+
+def adjust_contrast(img, factor):
+    mean_gray = _grayscale(img).mean(dim=(1, 2, 3), keepdim=True)
+    return _blend(img, mean_gray, factor)
+
+
+def adjust_saturation(img, factor):
+    return _blend(img, _grayscale(img), factor)
+
+
+class ColorJitter(object):
+    """
+    Batched equivalent of transforms.ColorJitter for float [N, 3, H, W] tensors in [0, 1].
+    Every sample draws its own factors and its own order of the three adjustments.
+    """
+
+    def __init__(self, brightness=0.125, contrast=0.125, saturation=0.125):
+        self.ranges = torch.tensor([brightness, contrast, saturation])
+        self.fns = [adjust_brightness, adjust_contrast, adjust_saturation]
+
+    def __call__(self, img, generator=None):
+        n = img.shape[0]
+        factors = 1 + (torch.rand(3, n, generator=generator) * 2 - 1) * self.ranges[:, None]
+        factors = factors.view(3, n, 1, 1, 1).to(img.device)
+        perms = torch.argsort(torch.rand(n, 3, generator=generator), dim=1)
+        keys = perms[:, 0] * 9 + perms[:, 1] * 3 + perms[:, 2]
+
+        # samples sharing the same order are adjusted together (at most 6 groups)
+        out = torch.empty_like(img)
+        for key in keys.unique().tolist():
+            idx = (keys == key).nonzero(as_tuple=True)[0]
+            order = perms[idx[0]].tolist()
+            idx = idx.to(img.device)
+            x = img[idx]
+            for fn_id in order:
+                x = self.fns[fn_id](x, factors[fn_id][idx])
+            out[idx] = x
+        return out
+
+
+def normalize(img):
+    m = torch.tensor(mean, device=img.device, dtype=img.dtype).view(1, 3, 1, 1)
+    s = torch.tensor(std, device=img.device, dtype=img.dtype).view(1, 3, 1, 1)
+    return img.sub_(m).div_(s)
+
+
+class ImageTransform(object):
+    """
+    Replaces the ToPILImage -> ColorJitter -> ToTensor -> Normalize chain.
+    Takes uint8 HWC images, either one sample (numpy or tensor) or a collated
+    [N, H, W, 3] batch, and returns normalized float CHW tensors.
+    """
+
+    def __init__(self, split):
+        self.jitter = ColorJitter(brightness=0.125, contrast=0.125, saturation=0.125) if split == 'train' else None
+
+    def __call__(self, img, generator=None):
+        if isinstance(img, np.ndarray):
+            img = torch.from_numpy(np.ascontiguousarray(img))
+        batched = img.dim() == 4
+        if not batched:
+            img = img.unsqueeze(0)
+        x = img.permute(0, 3, 1, 2).float().div_(255)
+        if self.jitter is not None:
+            x = self.jitter(x, generator)
+        x = normalize(x).contiguous()
+        return x if batched else x[0]
+
+
+def gen_trimap_batch(alpha, radius=(1, 20), generator=None):
+    """
+    Batched data.gen_trimap: the unknown band is the dilation of alpha > 0 minus the
+    erosion of alpha == 1, with a random radius per sample. Dilation/erosion are
+    repeated 3x3 max-pools, masked off once a sample reaches its radius.
+    :param alpha: float [N, 1, H, W] alpha in [0, 1], on any device
+    :param radius: inclusive (min, max) band radius in pixels
+    :return: uint8 [N, H, W] trimap with 0 / 128 / 255
+    """
+    n = alpha.shape[0]
+    radii = torch.randint(radius[0], radius[1] + 1, (n,), generator=generator)
+    r_max = int(radii.max())
+    radii = radii.to(alpha.device).view(n, 1, 1, 1)
+
+    dilated = (alpha > 0).float()
+    eroded = (alpha >= 1).float()
+    for step in range(1, r_max + 1):
+        active = radii >= step
+        dilated = torch.where(active, F.max_pool2d(dilated, 3, 1, 1), dilated)
+        eroded = torch.where(active, -F.max_pool2d(-eroded, 3, 1, 1), eroded)
+
+    trimap = torch.full(alpha.shape, 128, dtype=torch.uint8, device=alpha.device)
+    trimap[eroded > 0.5] = 255
+    trimap[dilated < 0.5] = 0
+    return trimap.squeeze(1)
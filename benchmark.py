@@ -0,0 +1,225 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+from augment import ImageTransform
+from composite import composite_u8, workspace
+import profiling
+from config import im_size
+
+
+def timeit(fn, repeat):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_transforms(repeat, batch_size):
+    """
+    Per-sample cost of the old PIL augmentation chain against ImageTransform,
+    applied per sample in the dataset and batched after collation.
+    """
+    img = np.random.randint(0, 256, (im_size, im_size, 3), np.uint8)
+    batch = torch.from_numpy(np.random.randint(0, 256, (batch_size, im_size, im_size, 3), np.uint8))
+    pil_transform = transforms.Compose([
+        transforms.ToPILImage(),
+        transforms.ColorJitter(brightness=0.125, contrast=0.125, saturation=0.125),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+    ])
+    transform = ImageTransform('train')
+
+    results = [
+        ('pil', timeit(lambda: pil_transform(img), repeat)),
+        ('tensor', timeit(lambda: transform(img), repeat)),
+        ('tensor batched', timeit(lambda: transform(batch), max(1, repeat // batch_size)) / batch_size),
+    ]
+    for name, seconds in results:
+        print('{:<16}{:8.3f} ms/sample'.format(name, seconds * 1000))
+
+
+def composite_float(fg, bg, a, w, h):
+    # the float32 blend composite4 used before composite_u8
+    fg = np.array(fg, np.float32)
+    bg = np.array(bg[0:h, 0:w], np.float32)
+    alpha = np.zeros((h, w, 1), np.float32)
+    alpha[:, :, 0] = a / 255.
+    im = alpha * fg + (1 - alpha) * bg
+    return im.astype(np.uint8)
+
+
+def bench_composite(repeat, sizes=((320, 320), (640, 640), (1080, 1920))):
+    """
+    float32 composite against the fixed-point kernel, with and without a reused output buffer.
+    """
+    for h, w in sizes:
+        fg = np.random.randint(0, 256, (h, w, 3), np.uint8)
+        bg = np.random.randint(0, 256, (h, w, 3), np.uint8)
+        a = np.random.randint(0, 256, (h, w), np.uint8)
+        out = workspace.get('bench', (h, w, 3), np.uint8)
+        results = [
+            ('float32', timeit(lambda: composite_float(fg, bg, a, w, h), repeat)),
+            ('uint8', timeit(lambda: composite_u8(fg, bg, a), repeat)),
+            ('uint8 + out', timeit(lambda: composite_u8(fg, bg, a, out), repeat)),
+        ]
+        for name, seconds in results:
+            print('{}x{} {:<14}{:8.3f} ms'.format(h, w, name, seconds * 1000))
+
+
+def synthetic_alpha(h, w, rng):
+    # soft-edged ellipse, so there is an unknown band like real mattes
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    cy, cx = rng.uniform(0.3, 0.7) * h, rng.uniform(0.3, 0.7) * w
+    d = np.sqrt(((yy - cy) / (0.35 * h)) ** 2 + ((xx - cx) / (0.35 * w)) ** 2)
+    return (np.clip((1 - d) * 20, 0, 1) * 255).astype(np.uint8)
+
+
+def make_synthetic_dataset(root, num_fgs=8, num_bgs_per_fg=4, seed=0):
+    """
+    Writes a small random dataset laid out like the real one: fg/mask/bg images
+    plus a train split for data.py, portrait lists and a background TFRecord shard
+    for data_human.py. Foreground sizes span the Adobe range.
+    """
+    from tfrecord_creator import write_shard
+
+    rng = np.random.RandomState(seed)
+    for folder in ['fg', 'mask', 'bg', 'portrait', 'tfrecord']:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    fg_sizes = [(600, 400), (1200, 800), (2000, 1500)]
+    fg_names, bg_names = [], []
+    for i in range(num_fgs):
+        h, w = fg_sizes[i % len(fg_sizes)]
+        name = 'fg_{}.png'.format(i)
+        cv.imwrite(os.path.join(root, 'fg', name), rng.randint(0, 256, (h, w, 3), np.uint8))
+        cv.imwrite(os.path.join(root, 'mask', name), synthetic_alpha(h, w, rng))
+        fg_names.append(name)
+    for i in range(num_fgs * num_bgs_per_fg):
+        name = 'bg_{}.jpg'.format(i)
+        cv.imwrite(os.path.join(root, 'bg', name), rng.randint(0, 256, (480, 640, 3), np.uint8))
+        bg_names.append(name)
+    pairs = np.stack([np.repeat(np.arange(num_fgs), num_bgs_per_fg), np.arange(len(bg_names))], 1)
+    np.save(os.path.join(root, 'train_split.npy'), pairs.astype(np.int32))
+
+    # data_human: 800x600 portraits with stored trimaps
+    portraits = {'img': [], 'alpha': [], 'trimap': []}
+    for i in range(num_fgs):
+        alpha = synthetic_alpha(800, 600, rng)
+        trimap = np.full(alpha.shape, 128, np.uint8)
+        trimap[alpha == 0] = 0
+        trimap[alpha == 255] = 255
+        images = {'img': rng.randint(0, 256, (800, 600, 3), np.uint8), 'alpha': alpha, 'trimap': trimap}
+        for kind, image in images.items():
+            filename = os.path.join('portrait', '{}_{}.png'.format(kind, i))
+            cv.imwrite(os.path.join(root, filename), image)
+            portraits[kind].append(filename)
+    for kind, names in portraits.items():
+        with open(os.path.join(root, '{}_portrait.txt'.format(kind)), 'w') as f:
+            f.write('\n'.join(names))
+    write_shard((os.path.join(root, 'tfrecord', 'bg_00000.tfrecord'),
+                 [os.path.join(root, 'bg', name) for name in bg_names], None), channels=3)
+    return fg_names, bg_names
+
+
+def load_datasets(root, fg_names, bg_names):
+    """
+    Points data.py and data_human.py at the synthetic dataset under `root`.
+    """
+    import data
+    data.fg_path = os.path.join(root, 'fg/')
+    data.a_path = os.path.join(root, 'mask/')
+    data.bg_path = os.path.join(root, 'bg/')
+    data.fg_files = fg_names
+    data.bg_files = bg_names
+
+    # data_human parses the command line when it is imported
+    argv = sys.argv
+    sys.argv = [argv[0], '--img-root-path', root]
+    try:
+        import data_human
+    finally:
+        sys.argv = argv
+    from tfrecord_reader import RandomAccessReader
+    data_human.bg_dataset = RandomAccessReader('bg', os.path.join(root, 'tfrecord/'))
+
+    os.chdir(root)
+    return {'data': data.HADataset('train'), 'data_human': data_human.HADataset('train')}
+
+
+def bench_stages(dataset, num_samples, batch_size):
+    profiling.reset()
+    profiling.enable()
+    samples = [dataset[i % len(dataset)] for i in range(num_samples)]
+    for i in range(0, len(samples), batch_size):
+        with profiling.stage('collate'):
+            default_collate(samples[i:i + batch_size])
+    profiling.enable(False)
+
+
+def bench_loader(dataset, num_workers, batch_size, num_batches):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, drop_last=True)
+    latencies = []
+    it = iter(loader)
+    next(it)  # worker start-up is not part of the steady state
+    start = time.perf_counter()
+    batch_start = start
+    for _ in range(num_batches):
+        try:
+            next(it)
+        except StopIteration:
+            it = iter(loader)
+            next(it)
+        now = time.perf_counter()
+        latencies.append(now - batch_start)
+        batch_start = now
+    elapsed = time.perf_counter() - start
+    return num_batches * batch_size / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def bench_pipeline(num_samples, workers, batch_sizes, num_batches):
+    """
+    Per-stage latency of HADataset.__getitem__ (in process) for data.py and
+    data_human.py, then loader throughput across worker counts and batch sizes.
+    """
+    root = tempfile.mkdtemp(prefix='hatt_bench_')
+    fg_names, bg_names = make_synthetic_dataset(root)
+    datasets = load_datasets(root, fg_names, bg_names)
+    for name, dataset in datasets.items():
+        bench_stages(dataset, num_samples, max(batch_sizes))
+        profiling.print_summary('\n{} per-stage latency ({} samples)'.format(name, num_samples))
+        print('{:<8}{:>8}{:>14}{:>14}{:>14}'.format('workers', 'batch', 'samples/s', 'p50 batch ms', 'p99 batch ms'))
+        for num_workers in workers:
+            for batch_size in batch_sizes:
+                rate, p50, p99 = bench_loader(dataset, num_workers, batch_size, num_batches)
+                print('{:<8}{:>8}{:>14.1f}{:>14.1f}{:>14.1f}'.format(num_workers, batch_size, rate, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data pipeline micro-benchmarks')
+    parser.add_argument('--suite', default='transforms', choices=['transforms', 'composite', 'pipeline'])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-samples', type=int, default=64, help='pipeline: samples timed per stage')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4], help='pipeline: DataLoader worker counts')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 32], help='pipeline: batch sizes')
+    parser.add_argument('--num-batches', type=int, default=20, help='pipeline: batches timed per configuration')
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads, 1 matches a loader worker')
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    if args.suite == 'transforms':
+        bench_transforms(args.repeat, args.batch_size)
+    elif args.suite == 'composite':
+        bench_composite(args.repeat)
+    elif args.suite == 'pipeline':
+        bench_pipeline(args.num_samples, args.workers, args.batch_sizes, args.num_batches)
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class Workspace(object):
+    """
+    Grow-only scratch buffers, so compositing does not allocate full-size
+    temporaries for every sample. Each process (DataLoader worker) owns its own.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        size = int(np.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(size, dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+
+workspace = Workspace()
+
+
+def composite_u8(fg, bg, a, out=None, ws=workspace):
+    """
+    uint8 alpha blending in 16-bit fixed point:
+        out = floor((a * fg + (255 - a) * bg) / 255)
+    which is what alpha * fg + (1 - alpha) * bg truncated to uint8 computes, without
+    the float32 copies of fg, bg and alpha.
+    :param fg: uint8 (h, w, c) foreground
+    :param bg: uint8 (h, w, c) background window
+    :param a: uint8 (h, w) alpha
+    :param out: optional uint8 (h, w, c) array receiving the result
+    """
+    h, w = a.shape[:2]
+    c = fg.shape[2] if fg.ndim == 3 else 1
+    shape = (h, w, c)
+    if out is None:
+        out = np.empty(shape, np.uint8)
+    if h * w == 0:
+        # empty crop window, nothing to blend
+        return out
+    fg = fg.reshape(shape)
+    bg = bg.reshape(h, w, -1)
+    a = a.reshape(h, w, 1)
+
+    t = ws.get('t', shape, np.uint16)
+    t2 = ws.get('t2', shape, np.uint16)
+    inv = ws.get('inv', (h, w, 1), np.uint16)
+    np.multiply(fg, a, out=t, dtype=np.uint16)
+    np.subtract(255, a, out=inv, dtype=np.uint16)
+    np.multiply(bg, inv, out=t2, dtype=np.uint16)
+    np.add(t, t2, out=t)
+    # t // 255 == (t + 1 + (t >> 8)) >> 8 for every t <= 255 * 255
+    np.right_shift(t, 8, out=t2)
+    np.add(t, t2, out=t)
+    np.add(t, 1, out=t)
+    np.right_shift(t, 8, out=t)
+    np.copyto(out, t, casting='unsafe')
+    return out
@@ -33,6 +33,24 @@ bg_path = 'data/bg/'
 # Path to folder where you want the composited images to go
 out_path = 'data/merged/'
 
+# Path to folder holding the background TFRecord shards used by data_human.py
+bg_tfrecord_dir = '/content/bg/'
+
+# (height, width) of every training background, used for size-aware pairing
+bg_meta_path = 'data/bg_meta.npy'
+
+# Path to folder holding downscaled levels of foregrounds larger than max_size (see pyramid.py)
+pyramid_path = 'data/pyramid/'
+
+# (row, col) of the unknown pixels of every training alpha (see unknown_index.py)
+unknown_index_path = 'data/unknown_index.npz'
+
+# Path to folder holding the pre-rendered validation split (see valid_store.py)
+valid_store_path = 'data/valid_store/'
+
+# Path to folder holding the decoded uint8 sample store (see sample_store.py)
+sample_store_path = 'data/store/'
+
 max_size = 1600
 fg_path_test = 'data/fg_test/'
 a_path_test = 'data/mask_test/'
@@ -1,6 +1,7 @@
 import math
 import os
 import random
+from collections import OrderedDict
 from time import time
 from tqdm import tqdm
 
@@ -8,23 +9,22 @@ import cv2 as cv
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-from torchvision import transforms
+from torch.utils.data.dataloader import default_collate
 
-from config import im_size, unknown_code, fg_path, bg_path, a_path, num_valid
-from utils import safe_crop
+from config import im_size, unknown_code, fg_path, bg_path, a_path, num_valid, bg_meta_path
+from utils import safe_crop, bg_window, SizeAwarePairing
+from sample_store import SampleStore
+from pyramid import Pyramid
+from unknown_index import UnknownIndex
+from augment import ImageTransform
+from composite import composite_u8, workspace
+from profiling import stage, SampleTracer
 
 # Data augmentation and normalization for training
 # Just normalization for validation
 data_transforms = {
-    'train': transforms.Compose([
-        transforms.ColorJitter(brightness=0.125, contrast=0.125, saturation=0.125),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-    ]),
-    'valid': transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ]),
+    'train': ImageTransform('train'),
+    'valid': ImageTransform('valid'),
 }
 
 kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (3, 3))
@@ -54,8 +54,7 @@ def get_alpha_test(name):
     return alpha
 
 
-def composite4(fg, bg, a, w, h):
-    fg = np.array(fg, np.float32)
+def composite4(fg, bg, a, w, h, out=None):
     bg_h, bg_w = bg.shape[:2]
     x = 0
     if bg_w > w:
@@ -63,29 +62,76 @@ def composite4(fg, bg, a, w, h):
     y = 0
     if bg_h > h:
         y = np.random.randint(0, bg_h - h)
-    bg = np.array(bg[y:y + h, x:x + w], np.float32)
-    alpha = np.zeros((h, w, 1), np.float32)
-    alpha[:, :, 0] = a / 255.
-    im = alpha * fg + (1 - alpha) * bg
-    im = im.astype(np.uint8)
+    bg = bg[y:y + h, x:x + w]
+    im = composite_u8(fg, bg, a, out)
     return im, a, fg, bg
 
 
-def process(im_name, bg_name):
+def load_bg_meta(filename=bg_meta_path):
+    """
+    (height, width) of every background in bg_files, read from the image headers
+    once and cached as an int32 array.
+    """
+    if os.path.exists(filename):
+        return np.load(filename)
+    from PIL import Image
+
+    sizes = np.zeros((len(bg_files), 2), np.int32)
+    for i, name in enumerate(tqdm(bg_files)):
+        with Image.open(bg_path + name) as img:
+            sizes[i] = img.size[::-1]
+    np.save(filename, sizes)
+    return sizes
+
+
+def read_images(im_name, bg_name):
     im = cv.imread(fg_path + im_name)
     a = cv.imread(a_path + im_name, 0)
-    h, w = im.shape[:2]
     bg = cv.imread(bg_path + bg_name)
-    bh, bw = bg.shape[:2]
-    wratio = w / bw
-    hratio = h / bh
-    ratio = wratio if wratio > hratio else hratio
-    if ratio > 1:
-        bg = cv.resize(src=bg, dsize=(math.ceil(bw * ratio), math.ceil(bh * ratio)), interpolation=cv.INTER_CUBIC)
+    return im, a, bg
+
+
+def process(im_name, bg_name):
+    im, a, bg = read_images(im_name, bg_name)
+    return process_images(im, a, bg)
+
 
+def process_images(im, a, bg):
+    h, w = im.shape[:2]
+    bg = bg_window(bg, w, h)
     return composite4(im, bg, a, w, h)
 
 
+def process_crop(im, a, bg, different_sizes=[(320, 320), (480, 480), (640, 640)], crop=None, centre=None):
+    """
+    Same samples as process_images + random_choice + safe_crop, but the crop window
+    is chosen from the foreground shape first so only that window gets composited.
+    :param crop: optional (x, y, crop_size) already chosen by the caller, e.g. on a pyramid level
+    :param centre: optional (row, col) the crop is centred on, see random_choice_shape
+    """
+    h, w = im.shape[:2]
+    with stage('random_choice'):
+        x, y, crop_size = crop if crop is not None else random_choice_shape(h, w, different_sizes, centre)
+    crop_height, crop_width = crop_size
+    # safe_crop reads rows from y and columns from x; the window is clipped to the image
+    x = min(x, max(w - 1, 0))
+    y = min(y, max(h - 1, 0))
+    x1 = min(x + crop_width, w)
+    y1 = min(y + crop_height, h)
+
+    with stage('resize'):
+        bg = bg_window(bg, w, h, (x, y, x1, y1))
+    with stage('composite'):
+        # safe_crop copies the composite, so it can live in the reusable workspace buffer
+        out = workspace.get('im', (y1 - y, x1 - x, 3), np.uint8)
+        img, alpha, _, _ = composite4(im[y:y1, x:x1], bg, a[y:y1, x:x1], x1 - x, y1 - y, out)
+    with stage('safe_crop'):
+        img = safe_crop(img, 0, 0, crop_size)
+        alpha = safe_crop(alpha, 0, 0, crop_size)
+    return img, alpha, crop_size
+
+
+# see augment.gen_trimap_batch for the batched version run after collation
 def gen_trimap(alpha):
     k_size = random.choice(range(1, 5))
     iterations = np.random.randint(1, 20)
@@ -100,74 +146,205 @@ def gen_trimap(alpha):
 
 
 # Randomly crop (image, trimap) pairs centered on pixels in the unknown regions.
-def random_choice(img, different_sizes=[(320, 320), (480, 480), (640, 640)]):
-    h, w, c = img.shape
-    # print(h, w, c)
-    if h < 320 or w < 320:
-        h_ = h
-        w_ = w
-        if w < 320:
-            w_ = 320
-        if h < 320:
-            h_ = 320
-        padded_img = np.zeros((h_, w_, c))
-        padded_img[:h, :w] = img
-        img = padded_img
-    h, w, c = img.shape
+def random_choice(img, different_sizes=[(320, 320), (480, 480), (640, 640)], centre=None):
+    h, w = img.shape[:2]
+    return random_choice_shape(h, w, different_sizes, centre)
+
+
+def random_choice_shape(h, w, different_sizes=[(320, 320), (480, 480), (640, 640)], centre=None):
+    """
+    :param centre: optional (row, col), e.g. an unknown pixel from UnknownIndex.sample;
+        the crop is then centred on it (clipped to the image) with x the column and
+        y the row offset, as safe_crop reads them
+    """
+    # images smaller than 320 are zero padded by safe_crop
+    if h < 320:
+        h = 320
+    if w < 320:
+        w = 320
     while(True):
         crop_size = random.choice(different_sizes)
         if h >= crop_size[0] and w >= crop_size[1]:
             break
     crop_height, crop_width = crop_size
-    if h == crop_height:
+    if centre is not None:
+        row, col = centre
+        x = min(max(col - crop_width // 2, 0), w - crop_width)
+        y = min(max(row - crop_height // 2, 0), h - crop_height)
+        return x, y, crop_size
+    # x is the column and y the row offset, as safe_crop reads them
+    if w == crop_width:
         x = 0
     else:
-        x = np.random.randint(0, high = h-crop_height)
-    if w == crop_width:
+        x = np.random.randint(0, high = w-crop_width)
+    if h == crop_height:
         y = 0
     else:
-        y = np.random.randint(0, high = w-crop_width)
+        y = np.random.randint(0, high = h-crop_height)
     return x, y, crop_size
 
 
 class HADataset(Dataset):
-    def __init__(self, split):
+    def __init__(self, split, use_store=False, raw=False, trace_dir=None, size_aware_bg=False, use_pyramid=False,
+                 crops_per_decode=1, fg_cache_size=0, unknown_crops=False):
         super(HADataset, self).__init__()
         self.split = split
-
-        filename = '{}_names.txt'.format(split)
-        with open(filename, 'r') as file:
-            self.names = file.read().splitlines()
+        # trace_dir: per-sample load latency from every worker, see profiling.report
+        self.tracer = SampleTracer(trace_dir) if trace_dir is not None else None
+        # raw: emit uint8 HWC image and uint8 alpha, normalized later by train.py on the device
+        self.raw = raw
+        # decoded fg/alpha/bg come from the memory-mapped store instead of PNG/JPEG files
+        self.store = SampleStore() if use_store else None
+        # foregrounds above max_size are read from the smallest pyramid level covering the crop
+        self.pyramid = Pyramid() if use_pyramid else None
+        # crops_per_decode: every item is K crops of one composite, batch them with collate_crops
+        self.crops_per_decode = crops_per_decode
+        # fg_cache_size: decoded (fg, alpha) kept per worker, pays off with sampler.LocalitySampler
+        self.fg_cache_size = fg_cache_size
+        self.fg_cache = OrderedDict()
+        # unknown_crops: centre crops on unknown pixels of the alpha (see unknown_index.py)
+        self.unknown = UnknownIndex() if unknown_crops else None
+
+        # int32 (fg_index, bg_index) rows, see gen_names
+        self.pairs = load_split(split)
+
+        # size_aware_bg: replace the listed background by one that already covers the foreground
+        self.pairing = None
+        if size_aware_bg:
+            bg_sizes = self.store.index['bg'][:, 1:3] if self.store is not None else load_bg_meta()
+            # only backgrounds of this split's pairs, so train never draws validation backgrounds
+            self.pairing = SizeAwarePairing(bg_sizes, np.asarray(self.pairs)[:, 1])
 
         self.transformer = data_transforms[split]
 
+    def read_fg(self, fcount):
+        if fcount in self.fg_cache:
+            self.fg_cache.move_to_end(fcount)
+            return self.fg_cache[fcount]
+        fg = self._read_fg(fcount)
+        if self.fg_cache_size > 0:
+            self.fg_cache[fcount] = fg
+            if len(self.fg_cache) > self.fg_cache_size:
+                self.fg_cache.popitem(last=False)
+        return fg
+
+    def _read_fg(self, fcount):
+        if self.store is not None:
+            return self.store.get('fg', fcount), self.store.get('alpha', fcount)
+        return cv.imread(fg_path + fg_files[fcount]), cv.imread(a_path + fg_files[fcount], 0)
+
+    def centre(self, fcount, shape):
+        if self.unknown is None:
+            return None
+        return self.unknown.sample(fcount, shape)
+
+    def read_fg_level(self, fcount, different_sizes):
+        """
+        Picks the crop in the max_size-normalized frame, then reads the pyramid level
+        for that crop size and maps the window onto it.
+        :return: fg, alpha, (x, y, crop_size) on the level, crop size in the normalized frame
+        """
+        name = fg_files[fcount]
+        h, w = self.pyramid.shape(name)
+        x, y, crop_size = random_choice_shape(h, w, different_sizes, self.centre(fcount, (h, w)))
+        im, a, factor = self.pyramid.read(name, crop_size)
+        level_size = (max(1, round(crop_size[0] * factor)), max(1, round(crop_size[1] * factor)))
+        return im, a, (round(x * factor), round(y * factor), level_size), crop_size
+
+    def read_bg(self, bcount):
+        if self.store is not None:
+            return self.store.get('bg', bcount)
+        return cv.imread(bg_path + bg_files[bcount])
+
     def __getitem__(self, i):
-        name = self.names[i]
-        fcount = int(name.split('.')[0].split('_')[0])
-        bcount = int(name.split('.')[0].split('_')[1])
-        im_name = fg_files[fcount]
-        bg_name = bg_files[bcount]
-        img, alpha, _, _ = process(im_name, bg_name)
+        if self.crops_per_decode > 1:
+            # item j stands for the pairs j*K .. j*K+K-1, one of them is decoded
+            start = i * self.crops_per_decode
+            i = start + np.random.randint(min(self.crops_per_decode, len(self.pairs) - start))
+        if self.tracer is None:
+            return self.sample(i)
+        with self.tracer.trace(self.name(i), i) as info:
+            return self.sample(i, info)
+
+    def sample(self, i, info=None):
+        if self.crops_per_decode > 1:
+            return self.sample_crops(i, info)
+        fcount, bcount = (int(v) for v in self.pairs[i])
         # crop size 320:640:480 = 1:1:1
         different_sizes = [(320, 320), (480, 480), (640, 640)]
 
+        crop = None
+        with stage('imread'):
+            if self.pyramid is not None and fg_files[fcount] in self.pyramid:
+                im, a, crop, crop_size = self.read_fg_level(fcount, different_sizes)
+            else:
+                im, a = self.read_fg(fcount)
+            if self.pairing is not None:
+                bcount = self.pairing.sample(im.shape[0], im.shape[1], bcount)
+            bg = self.read_bg(bcount)
+
         # trimap = gen_trimap(alpha)
-        x, y, crop_size = random_choice(img, different_sizes)
-        img = safe_crop(img, x, y, crop_size)
-        alpha = safe_crop(alpha, x, y, crop_size)
+        centre = self.centre(fcount, im.shape[:2]) if crop is None else None
+        img, alpha, level_size = process_crop(im, a, bg, different_sizes, crop, centre)
+        if crop is None:
+            crop_size = level_size
+        if info is not None:
+            info['crop'] = crop_size[0]
 
         # trimap = gen_trimap(alpha)
+        return self.emit(img, alpha)
+
+    def sample_crops(self, i, info=None):
+        """
+        Decodes and composites pair i once over the whole foreground, then draws
+        crops_per_decode independent crops and flips from it. With use_pyramid, a
+        foreground above max_size is read at its max_size-normalized level, since
+        the crops of different sizes share one composite.
+        :return: the emit() outputs of every crop, stacked along a new first dim
+        """
+        fcount, bcount = (int(v) for v in self.pairs[i])
+        with stage('imread'):
+            if self.pyramid is not None and fg_files[fcount] in self.pyramid:
+                im, a, _ = self.pyramid.read(fg_files[fcount], (im_size, im_size))
+            else:
+                im, a = self.read_fg(fcount)
+            if self.pairing is not None:
+                bcount = self.pairing.sample(im.shape[0], im.shape[1], bcount)
+            bg = self.read_bg(bcount)
+        with stage('composite'):
+            img, alpha, _, _ = process_images(im, a, bg)
 
+        different_sizes = [(320, 320), (480, 480), (640, 640)]
+        xs, ys = [], []
+        for _ in range(self.crops_per_decode):
+            with stage('random_choice'):
+                x, y, crop_size = random_choice(img, different_sizes, self.centre(fcount, img.shape[:2]))
+            with stage('safe_crop'):
+                crop_img = safe_crop(img, x, y, crop_size)
+                crop_alpha = safe_crop(alpha, x, y, crop_size)
+            if info is not None:
+                info.setdefault('crops', []).append(crop_size[0])
+            x, y = self.emit(crop_img, crop_alpha)
+            xs.append(x)
+            ys.append(y)
+        if self.raw:
+            return torch.stack(xs), torch.stack(ys)
+        return torch.stack(xs), np.stack(ys)
+
+    def emit(self, img, alpha):
         # Flip array left to right randomly (prob=1:1)
-        if np.random.random_sample() > 0.5:
-            img = np.fliplr(img)
-            # trimap = np.fliplr(trimap)
-            alpha = np.fliplr(alpha)
+        with stage('flip'):
+            if np.random.random_sample() > 0.5:
+                img = np.fliplr(img)
+                # trimap = np.fliplr(trimap)
+                alpha = np.fliplr(alpha)
 
         # x = torch.zeros((4, im_size, im_size), dtype=torch.float)
         img = img[..., ::-1]  # RGB
-        img = transforms.ToPILImage()(img)
-        img = self.transformer(img)
+        if self.raw:
+            return torch.from_numpy(np.ascontiguousarray(img)), torch.from_numpy(np.ascontiguousarray(alpha))
+        with stage('transform'):
+            img = self.transformer(img)
         x = img
 
         # y = np.empty((2, im_size, im_size), dtype=np.float32)
@@ -177,30 +354,60 @@ class HADataset(Dataset):
 
         return x, y
 
-    def __len__(self):
-        return len(self.names)
+    def name(self, i):
+        fcount, bcount = self.pairs[i]
+        return '{}_{}.png'.format(fcount, bcount)
 
-
-def gen_names():
-    num_fgs = 431
-    num_bgs = 43100
-    num_bgs_per_fg = 100
-
-    names = []
-    bcount = 0
-    for fcount in range(num_fgs):
-        for i in range(num_bgs_per_fg):
-            names.append(str(fcount) + '_' + str(bcount) + '.png')
-            bcount += 1
-
-    valid_names = random.sample(names, num_valid)
-    train_names = [n for n in names if n not in valid_names]
-
-    with open('valid_names.txt', 'w') as file:
-        file.write('\n'.join(valid_names))
-
-    with open('train_names.txt', 'w') as file:
-        file.write('\n'.join(train_names))
+    def __len__(self):
+        # an epoch still emits about len(pairs) crops
+        return math.ceil(len(self.pairs) / self.crops_per_decode)
+
+
+def collate_crops(batch):
+    """
+    collate_fn for HADataset(crops_per_decode=K): flattens the [N, K, ...] batch to
+    [N * K, ...], so batch_size=B / K gives batches of B crops.
+    """
+    return [t.flatten(0, 1) for t in default_collate(batch)]
+
+
+def load_split(split):
+    """
+    Loads the (fg_index, bg_index) pairs of a split. The binary manifest is memory
+    mapped; a split that only exists as {split}_names.txt is parsed once.
+    """
+    filename = '{}_split.npy'.format(split)
+    if os.path.exists(filename):
+        return np.load(filename, mmap_mode='r')
+    with open('{}_names.txt'.format(split), 'r') as file:
+        names = file.read().splitlines()
+    pairs = [name.split('.')[0].split('_') for name in names]
+    return np.array(pairs, np.int32).reshape(-1, 2)
+
+
+def gen_names(num_fgs=431, num_bgs_per_fg=100, num_valid=num_valid, seed=0, write_txt=True):
+    """
+    Splits every (fg, bg) pair into train/valid and saves both splits as int32
+    (fg_index, bg_index) manifests, {split}_split.npy. Pairs keep the fg-major order
+    of the name list; write_txt also writes the legacy {split}_names.txt files.
+    """
+    num_bgs = num_fgs * num_bgs_per_fg
+
+    pairs = np.empty((num_bgs, 2), np.int32)
+    pairs[:, 0] = np.repeat(np.arange(num_fgs, dtype=np.int32), num_bgs_per_fg)
+    pairs[:, 1] = np.arange(num_bgs, dtype=np.int32)
+
+    rng = np.random.RandomState(seed)
+    valid_ids = rng.choice(num_bgs, num_valid, replace=False)
+    is_valid = np.zeros(num_bgs, bool)
+    is_valid[valid_ids] = True
+    splits = {'valid': pairs[valid_ids], 'train': pairs[~is_valid]}
+
+    for split, split_pairs in splits.items():
+        np.save('{}_split.npy'.format(split), split_pairs)
+        if write_txt:
+            with open('{}_names.txt'.format(split), 'w') as file:
+                file.write('\n'.join('{}_{}.png'.format(f, b) for f, b in split_pairs.tolist()))
 
 from torch.utils.data import DataLoader
 
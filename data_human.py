@@ -1,4 +1,3 @@
-import math
 import os
 import random
 from tqdm import tqdm
@@ -6,67 +5,56 @@ from tqdm import tqdm
 import cv2 as cv
 import numpy as np
 import torch
-from torch.utils.data import Dataset
-from torchvision import transforms
-import tensorflow as tf
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
-import tfrecord_creator
-from config import im_size, unknown_code, fg_path, bg_path, a_path, num_valid
-from utils import safe_crop, parse_args
+from tfrecord_reader import RandomAccessReader, decode_image, parse_example, shard_filenames, iter_shard, shuffle_buffer
+from augment import ImageTransform
+from composite import composite_u8
+from profiling import stage, SampleTracer
+from config import im_size, unknown_code, fg_path, bg_path, a_path, num_valid, bg_tfrecord_dir
+from utils import safe_crop, parse_args, bg_window, SizeAwarePairing
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 global args
-args = parse_args()
+args = parse_args(known_only=True)
 
 # Data augmentation and normalization for training
 # Just normalization for validation
 data_transforms = {
-    'train': transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.ColorJitter(
-            brightness=0.125, contrast=0.125, saturation=0.125),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-    ]),
-    'valid': transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ]),
+    'train': ImageTransform('train'),
+    'valid': ImageTransform('valid'),
 }
 
 
 def return_raw_image(dataset):
     dataset_raw = []
     for image_features in dataset:
-        image_raw = image_features['image'].numpy()
-        image = tf.image.decode_jpeg(image_raw)
-        dataset_raw.append(image)
+        dataset_raw.append(decode_image(image_features))
 
     return dataset_raw
 
 
 # bg_dataset = tfrecord_creator.read("bg", "./data/tfrecord/")
 # bg_dataset = tfrecord_creator.read("bg", "../data/bg/")
-bg_dataset = tfrecord_creator.read("bg", "/content/bg/")
-bg_dataset = list(bg_dataset)
-print("___________________")
-print(len(bg_dataset))
-print("___________________")
+# Records are read on demand through the offset index stored next to the shards.
+# With --shared-bg, train.py builds one SharedRecordPool in the main process and
+# hands it to the datasets, so every worker attaches to the same copy.
+bg_dataset = RandomAccessReader("bg", bg_tfrecord_dir)
 
 
-def get_raw(type_of_dataset, count):
+def get_raw(type_of_dataset, count, dataset=None):
+    # dataset: the reader to use instead of the module level one
     if type_of_dataset == 'fg':
-        temp = fg_dataset[count]['image']
+        temp = fg_dataset[count]
         channels = 3
     elif type_of_dataset == 'bg':
-        temp = bg_dataset[count]['image']
+        temp = (dataset if dataset is not None else bg_dataset)[count]
         channels = 3
     else:
-        temp = a_dataset[count]['image']
+        temp = a_dataset[count]
         channels = 1
-    temp = tf.image.decode_jpeg(temp, channels=channels)
-    temp = np.asarray(temp).astype(np.float32)
+    # kept uint8: resize and composite both work on uint8
+    temp = decode_image(temp, channels=channels)
     return temp
 
 
@@ -83,31 +71,31 @@ def composite4(fg, bg, a, w, h):
     bg = bg[y:y + h, x:x + w]
     bg = np.reshape(bg, (h, w, -1))
     fg = np.reshape(fg, (h, w, -1))
-    alpha = np.zeros((h, w, 1), np.float32)
-    alpha[:, :, 0] = a / 255.
-    im = alpha * fg + (1 - alpha) * bg
-    im = im.astype(np.uint8)
+    im = composite_u8(fg, bg, a)
     return im, a, fg, bg
 
 
-def process(img_path, alpha_path, bcount):
+def process(img_path, alpha_path, bcount, bg=None, pairing=None, backgrounds=None):
+    # pairing: a SizeAwarePairing that replaces bcount once the foreground size is known
     img_root_path = args.img_root_path
     img_path = os.path.join(img_root_path, img_path)
     alpha_path = os.path.join(img_root_path, alpha_path)
-    im = cv.imread(img_path, cv.IMREAD_UNCHANGED)
-    a = cv.imread(alpha_path, cv.IMREAD_UNCHANGED)
+    with stage('imread'):
+        im = cv.imread(img_path, cv.IMREAD_UNCHANGED)
+        a = cv.imread(alpha_path, cv.IMREAD_UNCHANGED)
     # a = a[:, :, 3]
     h, w = im.shape[:2]
-    bg = get_raw("bg", bcount)
-    bh, bw = bg.shape[:2]
-    wratio = w / bw
-    hratio = h / bh
-    ratio = wratio if wratio > hratio else hratio
-    if ratio > 1:
-        bg = cv.resize(src=bg, dsize=(math.ceil(bw * ratio),
-                                      math.ceil(bh * ratio)), interpolation=cv.INTER_CUBIC)
+    if bg is None:
+        if pairing is not None:
+            bcount = pairing.sample(h, w, bcount)
+        with stage('decode'):
+            bg = get_raw("bg", bcount, backgrounds)
+    # only the w x h window that gets composited is upscaled
+    with stage('resize'):
+        bg = bg_window(bg, w, h)
 
-    return composite4(im, bg, a, w, h)
+    with stage('composite'):
+        return composite4(im, bg, a, w, h)
 
 
 def gen_trimap(trimap_path):
@@ -118,9 +106,15 @@ def gen_trimap(trimap_path):
 
 
 class HADataset(Dataset):
-    def __init__(self, split):
+    def __init__(self, split, raw=False, gen_trimap=False, trace_dir=None, size_aware_bg=False, backgrounds=None):
         super(HADataset, self).__init__()
         self.split = split
+        # trace_dir: per-sample load latency from every worker, see profiling.report
+        self.tracer = SampleTracer(trace_dir) if trace_dir is not None else None
+        # raw: emit uint8 HWC image and uint8 alpha, normalized later by train.py on the device
+        self.raw = raw
+        # gen_trimap: skip the trimap files, train.py builds trimaps per batch (augment.gen_trimap_batch)
+        self.gen_trimap = gen_trimap
 
         with open("img_portrait.txt", 'r') as f:
             self.imgs = f.read().splitlines()
@@ -139,32 +133,107 @@ class HADataset(Dataset):
             self.alpha = self.alpha[split_index:]
             self.trimap = self.trimap[split_index:]
 
-        self.num_bgs = len(bg_dataset)
+        # backgrounds: a reader built by the caller, e.g. one SharedRecordPool for all datasets
+        self.backgrounds = backgrounds if backgrounds is not None else bg_dataset
+        # backgrounds this split draws from; both splits share the whole pool for now
+        self.bg_ids = np.arange(len(self.backgrounds))
+        # size_aware_bg: only draw backgrounds of the split that already cover the portrait
+        self.pairing = SizeAwarePairing(self.backgrounds.sizes(), self.bg_ids) if size_aware_bg else None
 
         self.transformer = data_transforms[split]
 
     def __getitem__(self, i):
+        return self.sample(i)
+
+    def sample(self, i, bg=None):
+        if self.tracer is None:
+            return self._sample(i, bg)
+        with self.tracer.trace(self.imgs[i], i):
+            return self._sample(i, bg)
+
+    def _sample(self, i, bg=None):
+        # bg: an already decoded background, otherwise one is drawn from self.backgrounds
         img_path = self.imgs[i]
         alpha_path = self.alpha[i]
         trimap_path = self.trimap[i]
-        bcount = np.random.randint(self.num_bgs)
+        bcount = int(self.bg_ids[np.random.randint(len(self.bg_ids))]) if bg is None else None
         # size 800x600
 
-        img, alpha, _, _ = process(img_path, alpha_path, bcount)
-        trimap = gen_trimap(trimap_path)
+        img, alpha, _, _ = process(img_path, alpha_path, bcount, bg, self.pairing, self.backgrounds)
+        if self.gen_trimap:
+            # empty placeholder, collated to an [N, 0] tensor
+            trimap = np.zeros((0,), np.uint8)
+        else:
+            with stage('trimap'):
+                trimap = gen_trimap(trimap_path)
 
         # Flip array left to right randomly (prob=1:1)
-        if np.random.random_sample() > 0.5:
-            img = np.fliplr(img)
-            trimap = np.fliplr(trimap).copy()
-            alpha = np.fliplr(alpha)
-
-        return self.transformer(img), alpha / 255.0, trimap, img_path
+        with stage('flip'):
+            if np.random.random_sample() > 0.5:
+                img = np.fliplr(img)
+                if not self.gen_trimap:
+                    trimap = np.fliplr(trimap).copy()
+                alpha = np.fliplr(alpha)
+
+        if self.raw:
+            img = torch.from_numpy(np.ascontiguousarray(img))
+            alpha = torch.from_numpy(np.ascontiguousarray(alpha))
+            return img, alpha, torch.from_numpy(np.ascontiguousarray(trimap)), img_path
+        with stage('transform'):
+            img = self.transformer(img)
+        return img, alpha / 255.0, trimap, img_path
 
     def __len__(self):
         return len(self.imgs)
 
 
+class HAStreamDataset(IterableDataset):
+    """
+    Streaming variant of HADataset. Background shards are split between the
+    DataLoader workers and each worker reads its shards sequentially, drawing
+    backgrounds through a bounded shuffle buffer. Foregrounds follow a per-epoch
+    permutation shared by all workers, each worker taking every num_workers-th one,
+    so an epoch still covers every foreground once.
+    """
+
+    def __init__(self, split, shuffle_size=256, tfrecord_dir=bg_tfrecord_dir, seed=42, check_crc=None, **kwargs):
+        super(HAStreamDataset, self).__init__()
+        # check_crc: see tfrecord_reader.resolve_check_crc
+        self.check_crc = check_crc
+        self.dataset = HADataset(split, **kwargs)
+        self.shards = shard_filenames("bg", tfrecord_dir)
+        if not self.shards:
+            raise IOError('no bg .tfrecord shards found in {}'.format(tfrecord_dir))
+        self.shuffle_size = shuffle_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def backgrounds(self, shards, rng):
+        while True:
+            for shard in rng.permutation(shards):
+                for record in iter_shard(shard, self.check_crc):
+                    yield record
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        shards = self.shards[worker_id::num_workers] or [self.shards[worker_id % len(self.shards)]]
+        rng = np.random.RandomState((self.seed + self.epoch * 1000 + worker_id) % 2 ** 32)
+
+        indices = np.random.RandomState(self.seed + self.epoch).permutation(len(self.dataset))
+        records = shuffle_buffer(self.backgrounds(shards, rng), self.shuffle_size, rng)
+        for i in indices[worker_id::num_workers]:
+            with stage('decode'):
+                bg = decode_image(parse_example(next(records)))
+            yield self.dataset.sample(int(i), bg)
+
+
 def gen_names():
     num_fgs = 431
     num_bgs = 43100
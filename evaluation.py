@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+
+from augment import normalize, gen_trimap_batch
+
+# inputs are padded to a multiple of the encoder output stride, outputs cropped back
+stride = 32
+
+
+def _as_tensor(x):
+    return x if isinstance(x, torch.Tensor) else torch.from_numpy(np.ascontiguousarray(x))
+
+
+def _round_up(x, multiple):
+    return -(-x // multiple) * multiple
+
+
+def collate_padded(batch, stride=stride):
+    """
+    collate_fn for variable-size (img, alpha, trimap, path) samples, as emitted by
+    data_human.HADataset and valid_store.HAValidStore. Every sample is zero padded
+    at the bottom and right to the largest size of the batch, rounded up to stride.
+    Raw uint8 HWC images are made CHW and stay uint8.
+    :return: img [N, C, H, W], alpha [N, H, W], trimap [N, H, W] (or [N, 0] if the
+        dataset generates them), paths and the (h, w) of every sample
+    """
+    imgs, alphas, trimaps, paths = zip(*batch)
+    imgs = [_as_tensor(img) for img in imgs]
+    imgs = [img.permute(2, 0, 1) if img.dtype == torch.uint8 else img for img in imgs]
+    alphas = [_as_tensor(alpha) for alpha in alphas]
+    trimaps = [_as_tensor(trimap) for trimap in trimaps]
+    sizes = torch.tensor([img.shape[1:] for img in imgs], dtype=torch.int64)
+    n = len(imgs)
+    h = _round_up(int(sizes[:, 0].max()), stride)
+    w = _round_up(int(sizes[:, 1].max()), stride)
+
+    img_batch = imgs[0].new_zeros((n, imgs[0].shape[0], h, w))
+    alpha_batch = alphas[0].new_zeros((n, h, w))
+    has_trimap = all(trimap.dim() >= 2 for trimap in trimaps)
+    trimap_batch = torch.zeros((n, h, w) if has_trimap else (n, 0), dtype=torch.uint8)
+    for i, (sh, sw) in enumerate(sizes.tolist()):
+        img_batch[i, :, :sh, :sw] = imgs[i]
+        alpha_batch[i, :sh, :sw] = alphas[i].reshape(sh, sw)
+        if has_trimap:
+            trimap_batch[i, :sh, :sw] = trimaps[i].reshape(sh, sw, -1)[:, :, 0]
+    return img_batch, alpha_batch, trimap_batch, list(paths), sizes
+
+
+def evaluate(model, loader, device):
+    """
+    Runs model over a loader built with collate_padded, in eval mode and under
+    torch.inference_mode(), and streams the results sample by sample.
+    :return: generator of dicts holding 'path' and, cropped back to the sample size
+        with a batch dim of 1 and on device, 'trimap_out' [1, 3, h, w],
+        'alpha_out' [1, 1, h, w], 'alpha' [1, 1, h, w] in [0, 1] and 'trimap' [1, h, w]
+    """
+    training = model.training
+    model.eval()
+    try:
+        for img, alpha, trimap, paths, sizes in loader:
+            with torch.inference_mode():
+                img = img.to(device, non_blocking=True)
+                if img.dtype == torch.uint8:
+                    img = normalize(img.float().div_(255))
+                raw = alpha.dtype == torch.uint8
+                alpha = alpha.to(device, non_blocking=True).float().unsqueeze(1)
+                if raw:
+                    alpha.div_(255)
+                if trimap.numel() == 0:
+                    trimap = gen_trimap_batch(alpha)
+                else:
+                    trimap = trimap.to(device, non_blocking=True)
+                trimap_out, alpha_out = model(img)
+            for i, (h, w) in enumerate(sizes.tolist()):
+                yield {
+                    'path': paths[i],
+                    'trimap_out': trimap_out[i:i + 1, :, :h, :w],
+                    'alpha_out': alpha_out[i:i + 1, :, :h, :w],
+                    'alpha': alpha[i:i + 1, :, :h, :w],
+                    'trimap': trimap[i:i + 1, :h, :w],
+                }
+    finally:
+        model.train(training)
@@ -0,0 +1,179 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Per-stage timings of the data pipeline, collected only while enabled so the
+# instrumented code paths cost next to nothing in normal training.
+enabled = False
+timings = defaultdict(list)
+# stage events of the sample SampleTracer is currently timing, if any
+current_events = None
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def reset():
+    timings.clear()
+
+
+@contextmanager
+def stage(name):
+    if not enabled and current_events is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if enabled:
+            timings[name].append(end - start)
+        if current_events is not None:
+            current_events.append((name, start, end))
+
+
+def summary():
+    """
+    Returns {stage: (count, p50, p99, total)} with times in seconds.
+    """
+    result = {}
+    for name, values in timings.items():
+        values = np.asarray(values)
+        result[name] = (len(values), np.percentile(values, 50), np.percentile(values, 99), values.sum())
+    return result
+
+
+def print_summary(title=''):
+    if title:
+        print(title)
+    print('{:<16}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'count', 'p50 ms', 'p99 ms', 'total s'))
+    for name, (count, p50, p99, total) in sorted(summary().items(), key=lambda item: -item[1][3]):
+        print('{:<16}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}'.format(name, count, p50 * 1000, p99 * 1000, total))
+
+
+class SampleTracer(object):
+    """
+    Per-sample load latency. Every process (main or DataLoader worker) appends one
+    JSON line per sample to trace_<pid>.jsonl in trace_dir, with the stage
+    breakdown from stage(); report() merges the files of all workers.
+    time.perf_counter is CLOCK_MONOTONIC on Linux, so timestamps line up across workers.
+    """
+
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+        self._file = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
+    def _write(self, record):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            filename = os.path.join(self.trace_dir, 'trace_{}.jsonl'.format(self._pid))
+            self._file = open(filename, 'a', buffering=1)
+        self._file.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def trace(self, name, index):
+        """
+        Times one sample; extra fields (e.g. 'crop') can be stored in the yielded dict.
+        """
+        global current_events
+        info = {}
+        current_events = []
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            end = time.perf_counter()
+            events, current_events = current_events, None
+            record = {'name': name, 'index': int(index), 'start': start, 'end': end,
+                      'pid': os.getpid(), 'tid': threading.get_ident(), 'stages': events}
+            record.update(info)
+            self._write(record)
+
+
+def load_traces(trace_dir):
+    records = []
+    for filename in glob.glob(os.path.join(trace_dir, 'trace_*.jsonl')):
+        with open(filename) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def write_chrome_trace(records, filename):
+    # viewable in chrome://tracing or Perfetto
+    events = []
+    for r in records:
+        events.append({'name': r['name'], 'ph': 'X', 'ts': r['start'] * 1e6, 'dur': (r['end'] - r['start']) * 1e6,
+                       'pid': r['pid'], 'tid': r['tid'], 'args': {'index': r['index'], 'crop': r.get('crop'), 'crops': r.get('crops')}})
+        for stage_name, start, end in r['stages']:
+            events.append({'name': stage_name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                           'pid': r['pid'], 'tid': r['tid']})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def report(trace_dir, top=20, chrome_trace=None):
+    """
+    Prints the slowest sample names (mean over their loads) and the latency
+    distribution per crop size, and optionally writes a Chrome trace.
+    Samples holding several crops ('crops') count once per crop, with an equal
+    share of their latency.
+    """
+    records = load_traces(trace_dir)
+    if not records:
+        print('no traces in {}'.format(trace_dir))
+        return
+    per_name = defaultdict(list)
+    per_crop = defaultdict(list)
+    for r in records:
+        duration = r['end'] - r['start']
+        per_name[r['name']].append(duration)
+        # multi-crop samples (data.HADataset crops_per_decode) split their time over their crops
+        crops = r.get('crops') or [r.get('crop')]
+        for crop in crops:
+            per_crop[crop].append(duration / len(crops))
+
+    print('{} samples from {} processes'.format(len(records), len(set(r['pid'] for r in records))))
+    print('\nslowest samples')
+    print('{:<40}{:>8}{:>12}{:>12}'.format('name', 'loads', 'mean ms', 'max ms'))
+    slowest = sorted(per_name.items(), key=lambda item: -np.mean(item[1]))[:top]
+    for name, values in slowest:
+        print('{:<40}{:>8}{:>12.2f}{:>12.2f}'.format(name, len(values), np.mean(values) * 1000, np.max(values) * 1000))
+
+    print('\nlatency per crop size')
+    print('{:<12}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('crop', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for crop, values in sorted(per_crop.items(), key=lambda item: str(item[0])):
+        values = np.asarray(values) * 1000
+        print('{:<12}{:>8}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.2f}'.format(
+            str(crop), len(values), values.mean(), *np.percentile(values, [50, 90, 99])))
+
+    if chrome_trace is not None:
+        write_chrome_trace(records, chrome_trace)
+        print('\nChrome trace written to {}'.format(chrome_trace))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Slow-sample report from HADataset traces')
+    parser.add_argument('trace_dir', type=str)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--chrome-trace', type=str, default=None)
+    args = parser.parse_args()
+    report(args.trace_dir, args.top, args.chrome_trace)
@@ -0,0 +1,83 @@
+import json
+import os
+
+import cv2 as cv
+from tqdm import tqdm
+
+from config import im_size, max_size, fg_path, a_path, pyramid_path
+
+index_filename = 'index.json'
+
+
+def level_factors(different_sizes=[(320, 320), (480, 480), (640, 640)]):
+    # a crop of c pixels is resized to im_size, so a level scaled by im_size / c loses nothing
+    return sorted(set(min(1., im_size / crop_size[0]) for crop_size in different_sizes))
+
+
+def level_dir(out_dir, kind, factor):
+    return os.path.join(out_dir, kind, '{:.4f}'.format(factor))
+
+
+def build_pyramid(names, fg_dir=fg_path, a_dir=a_path, out_dir=pyramid_path, max_size=max_size,
+                  factors=level_factors()):
+    """
+    Foregrounds whose longer side exceeds max_size are normalized to max_size and
+    stored, with their alpha, at every crop level factor of that normalized size.
+    Smaller foregrounds are left out and keep being read from fg_dir.
+    """
+    index = {}
+    for name in tqdm(names):
+        fg = cv.imread(fg_dir + name)
+        a = cv.imread(a_dir + name, 0)
+        h, w = fg.shape[:2]
+        if max(h, w) <= max_size:
+            continue
+        scale = max_size / max(h, w)
+        base_h, base_w = round(h * scale), round(w * scale)
+        levels = {}
+        for factor in factors:
+            size = (max(1, round(base_w * factor)), max(1, round(base_h * factor)))
+            for kind, img in [('fg', fg), ('mask', a)]:
+                folder = level_dir(out_dir, kind, factor)
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                cv.imwrite(os.path.join(folder, name), cv.resize(img, size, interpolation=cv.INTER_AREA))
+            levels['{:.4f}'.format(factor)] = [size[1], size[0]]
+        index[name] = {'shape': [base_h, base_w], 'levels': levels}
+    with open(os.path.join(out_dir, index_filename), 'w') as f:
+        json.dump(index, f)
+
+
+class Pyramid(object):
+    """
+    Reads the smallest stored level that still covers a crop at im_size.
+    """
+
+    def __init__(self, out_dir=pyramid_path):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, index_filename)) as f:
+            self.index = json.load(f)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def shape(self, name):
+        # (h, w) of the max_size-normalized foreground, the frame crops are drawn in
+        return tuple(self.index[name]['shape'])
+
+    def read(self, name, crop_size):
+        """
+        :return: fg, alpha and the level factor relative to shape(name)
+        """
+        needed = min(1., im_size / crop_size[0])
+        factors = sorted(float(tag) for tag in self.index[name]['levels'])
+        factor = next((f for f in factors if f >= needed - 1e-4), factors[-1])
+        fg = cv.imread(os.path.join(level_dir(self.out_dir, 'fg', factor), name))
+        a = cv.imread(os.path.join(level_dir(self.out_dir, 'mask', factor), name), 0)
+        return fg, a, factor
+
+
+if __name__ == '__main__':
+    from data import fg_files
+
+    build_pyramid(fg_files)
@@ -1 +1,2 @@
-pytorch-msssim
\ No newline at end of file
+pytorch-msssim
+crc32c
@@ -0,0 +1,105 @@
+import os
+
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+
+from config import fg_path, a_path, bg_path, sample_store_path
+
+# Every decoded image lives in one flat uint8 file; the index keeps, per kind,
+# one row of (offset, height, width, channels) for each image in name order.
+data_filename = 'samples.bin'
+index_filename = 'index.npz'
+
+
+def write_arrays(samples, out_dir=sample_store_path, extra=None):
+    """
+    Appends uint8 images to a contiguous store.
+    :param samples: iterable of dicts kind -> uint8 (h, w) or (h, w, c) array
+    :param out_dir: folder receiving samples.bin and index.npz
+    :param extra: optional dict of name -> array saved alongside in index.npz
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rows = {}
+    offset = 0
+    with open(os.path.join(out_dir, data_filename), 'wb') as f:
+        for sample in samples:
+            for kind, img in sample.items():
+                img = np.ascontiguousarray(img, np.uint8)
+                h, w = img.shape[:2]
+                c = img.shape[2] if img.ndim == 3 else 1
+                rows.setdefault(kind, []).append((offset, h, w, c))
+                f.write(img.tobytes())
+                offset += img.nbytes
+    index = {kind: np.array(kind_rows, np.int64).reshape(-1, 4) for kind, kind_rows in rows.items()}
+    np.savez(os.path.join(out_dir, index_filename), **index, **(extra or {}))
+
+
+def read_files(files, desc=None):
+    for filename, flag in tqdm(files, desc=desc):
+        img = cv.imread(filename, flag)
+        if img is None:
+            raise IOError('cannot decode {}'.format(filename))
+        yield img
+
+
+def write_store(sources, out_dir=sample_store_path):
+    """
+    Decodes images once and appends them to a contiguous uint8 store.
+    :param sources: dict of kind -> list of (filename, imread flag)
+    :param out_dir: folder receiving samples.bin and index.npz
+    """
+    write_arrays(({kind: img} for kind, files in sources.items() for img in read_files(files, kind)), out_dir)
+
+
+def build_store(fg_files, bg_files, out_dir=sample_store_path):
+    sources = {
+        'fg': [(fg_path + name, cv.IMREAD_COLOR) for name in fg_files],
+        'alpha': [(a_path + name, cv.IMREAD_GRAYSCALE) for name in fg_files],
+        'bg': [(bg_path + name, cv.IMREAD_COLOR) for name in bg_files],
+    }
+    write_store(sources, out_dir)
+
+
+class SampleStore(object):
+    """
+    Read-only view over a store written by write_store. The memory map is opened
+    lazily so every DataLoader worker maps the file itself instead of inheriting it.
+    """
+
+    def __init__(self, store_dir=sample_store_path):
+        self.store_dir = store_dir
+        with np.load(os.path.join(store_dir, index_filename)) as index:
+            self.index = {kind: index[kind] for kind in index.files}
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.store_dir, data_filename), dtype=np.uint8, mode='r')
+        return self._data
+
+    def count(self, kind):
+        return len(self.index[kind])
+
+    def shape(self, kind, i):
+        _, h, w, c = self.index[kind][i]
+        return (int(h), int(w)) if c == 1 else (int(h), int(w), int(c))
+
+    def get(self, kind, i):
+        # zero-copy view into the mapped file, laid out exactly like cv.imread output
+        offset, h, w, c = (int(v) for v in self.index[kind][i])
+        view = self.data[offset:offset + h * w * c]
+        return view.reshape(self.shape(kind, i))
+
+
+if __name__ == '__main__':
+    from data import fg_files, bg_files
+
+    build_store(fg_files, bg_files)
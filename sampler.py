@@ -0,0 +1,93 @@
+from collections import OrderedDict
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LocalitySampler(Sampler):
+    """
+    Shuffles a foreground-major pair list so that samples of the same foreground
+    stay close together. Every foreground's pairs are shuffled and cut into runs of
+    run_length; the runs of `window` consecutive foregrounds (in a random foreground
+    order) are then shuffled together. A run is mostly inside one batch, and so
+    decoded by one DataLoader worker, while the order stays random at the scale of
+    a window.
+    """
+
+    def __init__(self, pairs, run_length=4, window=16, seed=0):
+        self.fgs = np.asarray(pairs)[:, 0]
+        self.run_length = run_length
+        self.window = window
+        self.seed = seed
+        self.epoch = 0
+        self.blocks = [np.flatnonzero(self.fgs == f) for f in np.unique(self.fgs)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def order(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = []
+        fg_order = rng.permutation(len(self.blocks))
+        for start in range(0, len(fg_order), self.window):
+            runs = []
+            for f in fg_order[start:start + self.window]:
+                block = rng.permutation(self.blocks[f])
+                runs.extend(block[i:i + self.run_length] for i in range(0, len(block), self.run_length))
+            for r in rng.permutation(len(runs)):
+                order.extend(runs[r].tolist())
+        return order
+
+    def __iter__(self):
+        return iter(self.order())
+
+    def __len__(self):
+        return len(self.fgs)
+
+
+def locality_stats(order, fgs, batch_size=32, num_workers=4, cache_size=8):
+    """
+    Simulates one LRU cache of decoded foregrounds per DataLoader worker, with
+    batches handed to the workers round-robin as the DataLoader does.
+    :param order: dataset indices in sampling order
+    :param fgs: foreground id of every dataset index
+    :return: dict with the cache hit rate and the mean number of distinct foregrounds per batch
+    """
+    caches = [OrderedDict() for _ in range(num_workers)]
+    hits = 0
+    distinct = []
+    for b, start in enumerate(range(0, len(order), batch_size)):
+        batch = [fgs[i] for i in order[start:start + batch_size]]
+        distinct.append(len(set(batch)))
+        cache = caches[b % num_workers]
+        for f in batch:
+            if f in cache:
+                hits += 1
+                cache.move_to_end(f)
+            else:
+                cache[f] = True
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+    return {'hit_rate': hits / max(1, len(order)), 'fgs_per_batch': float(np.mean(distinct)) if distinct else 0.}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from data import load_split
+
+    parser = argparse.ArgumentParser(description='fg cache hit rate of LocalitySampler against a plain shuffle')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--run-length', type=int, default=4)
+    parser.add_argument('--window', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cache-size', type=int, default=8)
+    args = parser.parse_args()
+
+    pairs = load_split(args.split)
+    fgs = np.asarray(pairs)[:, 0]
+    sampler = LocalitySampler(pairs, args.run_length, args.window)
+    for name, order in [('shuffle', np.random.permutation(len(fgs)).tolist()), ('locality', sampler.order())]:
+        stats = locality_stats(order, fgs, args.batch_size, args.workers, args.cache_size)
+        print('{:<10} hit rate {:.3f}  fgs per batch {:.1f}'.format(name, stats['hit_rate'], stats['fgs_per_batch']))
@@ -1,16 +1,18 @@
 import math
+import os
 import argparse
 
 import cv2 as cv
 import numpy as np
 import torch
-from torchvision import transforms
+from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 
 from config import device, fg_path_test, a_path_test, bg_path_test
-from data_gen import data_transforms, fg_test_files, bg_test_files
+from data_human import HADataset
 from utils import compute_mse, compute_sad, AverageMeter, get_logger, compute_gradient_loss, compute_connectivity_error, ensure_folder, draw_str
 from model import Model
+from evaluation import evaluate, collate_padded
 
 device = 'cuda'
 output_folder = 'trimap_human_2_32_train'
@@ -21,39 +23,26 @@ def val(val_loader, model):
     gradient_losses = AverageMeter()
     connectivity_losses = AverageMeter()
 
-    model.eval()
-    
-    # Batches
-    for i, (img, alpha_label, trimap_label, img_path) in enumerate(val_loader):
-        # Move to GPU, if available
-        img = img.type(torch.FloatTensor).to(device)  # [N, 4, 320, 320]
-        alpha_label = alpha_label.type(
-            torch.FloatTensor).to(device)  # [N, 320, 320]
-        alpha_label = alpha_label.unsqueeze(1)
-        trimap_label = trimap_label.to(device)
-        # Forward prop.
-        trimap_out, alpha_out = model(img)  # [N, 3, 320, 320]
-        trimap_out.squeeze(0)
-        # alpha_out = alpha_out.reshape((-1, 1, im_size * im_size))  # [N, 320*320]
-        trimap_out = trimap_out.argmax(dim=1)
-        trimap_out = trimap_out.squeeze(0)
-        trimap_out[trimap_out==1] = 128
-        trimap_out[trimap_out==2] = 255
-        trimap_out = np.array(trimap_out.cpu(), dtype=np.uint8)
-        # print(trimap_out)
-        # return trimap, alpha
+    # Batches, evaluated without autograd and streamed back per sample
+    for out in evaluate(model, val_loader, device):
+        img_path = out['path']
+        alpha_out = out['alpha_out'][0, 0].float().cpu().numpy()
+        alpha_label = out['alpha'][0, 0].cpu().numpy()
+        trimap_label = out['trimap'][0].cpu().numpy()
         mse_loss = compute_mse(alpha_out, alpha_label, trimap_label)
         sad_loss = compute_sad(alpha_out, alpha_label)
         gradient_loss = compute_gradient_loss(alpha_out, alpha_label, trimap_label)
         connectivity_loss = compute_connectivity_error(alpha_out, alpha_label, trimap_label)
-        print("sad:{} mse:{} gradient: {} connectivity: {}".format(sad_loss.item(), mse_loss.item(), gradient_loss, connectivity_loss))
+        mse_losses.update(mse_loss)
+        sad_losses.update(sad_loss)
+        gradient_losses.update(gradient_loss)
+        connectivity_losses.update(connectivity_loss)
+        print("sad:{} mse:{} gradient: {} connectivity: {}".format(sad_loss, mse_loss, gradient_loss, connectivity_loss))
         # f.write("sad:{} mse:{} gradient: {} connectivity: {}".format(sad_loss.item(), mse_loss.item(), gradient_loss, connectivity_loss) + "\n")
 
-        alpha_out = (alpha_out.copy() * 255).astype(np.uint8)
-        draw_str(alpha_out, (10, 20), "sad:{} mse:{} gradient: {} connectivity: {}".format(sad_loss.item(), mse_loss.item(), gradient_loss, connectivity_loss))
-        cv.imwrite(os.path.join('images/test/out/', output_folder, img_path[0].split('/')[-1]), alpha_out)
-        # print(os.path.join('images/test/out', output_folder, img_path[0].split('/')[-1]))
-        # cv.imwrite(os.path.join('images/test/out', output_folder, img_path[0].split('/')[-1]), alpha_out)
+        alpha_out = (alpha_out * 255).astype(np.uint8)
+        draw_str(alpha_out, (10, 20), "sad:{} mse:{} gradient: {} connectivity: {}".format(sad_loss, mse_loss, gradient_loss, connectivity_loss))
+        cv.imwrite(os.path.join('images/test/out/', output_folder, img_path.split('/')[-1]), alpha_out)
     print("sad_avg:{} mse_avg:{} gradient_avg: {} connectivity_avg: {}".format(sad_losses.avg, mse_losses.avg, gradient_losses.avg, connectivity_losses.avg))
 
 if __name__ == '__main__':
@@ -62,9 +51,10 @@ if __name__ == '__main__':
     parser.add_argument('--checkpoint', type=str, default='BEST_checkkpoint.tar')
     parser.add_argument('--output-folder', type=str)
     parser.add_argument('--device', type=str)
+    parser.add_argument('--batch-size', type=int, default=8)
     args = parser.parse_args()
     try:
-        os.makedirs(ps.path.join('images', 'test', 'out', output_folder))
+        os.makedirs(os.path.join('images', 'test', 'out', output_folder))
     except:
         pass
 
@@ -73,10 +63,11 @@ if __name__ == '__main__':
         checkpoint = torch.load(checkpoint, map_location=lambda storage, loc: storage)
     else:
         checkpoint = torch.load(checkpoint)
-    model_state_dict = checkpoint['state_dict']
+    model_state_dict = checkpoint['model_state_dict']
     model = Model('train_alpha').to(device)
     model.load_state_dict(model_state_dict)
-    val_loader  = DataLoader(HADataset('valid'), batch_size=1, shuffle=False, num_workers=2)
+    val_loader  = DataLoader(HADataset('valid'), batch_size=args.batch_size, shuffle=False, num_workers=2,
+                             collate_fn=collate_padded)
     val(val_loader, model)
 
 
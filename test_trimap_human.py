@@ -21,33 +21,22 @@ from config import device, im_size, grad_clip, print_freq
 from model import Model
 from data_human import HADataset
 from loss import LossFunction
+from evaluation import evaluate, collate_padded
 
 device = 'cuda'
 output_folder = 'trimap_human_2_32_train'
 
 def val(val_loader, model):
-    model.eval()
-    
-    # Batches
-    for i, (img, alpha_label, trimap_label, img_path) in enumerate(val_loader):
-        # Move to GPU, if available
-        img = img.type(torch.FloatTensor).to(device)  # [N, 4, 320, 320]
-        alpha_label = alpha_label.type(
-            torch.FloatTensor).to(device)  # [N, 320, 320]
-        alpha_label = alpha_label.unsqueeze(1)
-        trimap_label = trimap_label.to(device)
-        # Forward prop.
-        trimap_out, alpha_out = model(img)  # [N, 3, 320, 320]
-        trimap_out.squeeze(0)
-        # alpha_out = alpha_out.reshape((-1, 1, im_size * im_size))  # [N, 320*320]
-        trimap_out = trimap_out.argmax(dim=1)
-        trimap_out = trimap_out.squeeze(0)
+    # Batches, evaluated without autograd and streamed back per sample
+    for out in evaluate(model, val_loader, device):
+        img_path = out['path']
+        trimap_out = out['trimap_out'][0].argmax(dim=0)
         trimap_out[trimap_out==1] = 128
         trimap_out[trimap_out==2] = 255
         trimap_out = np.array(trimap_out.cpu(), dtype=np.uint8)
         # print(trimap_out)
-        print(os.path.join('images/test/out', output_folder, img_path[0].split('/')[-1]))
-        cv.imwrite(os.path.join('images/test/out', output_folder, img_path[0].split('/')[-1]), trimap_out)
+        print(os.path.join('images/test/out', output_folder, img_path.split('/')[-1]))
+        cv.imwrite(os.path.join('images/test/out', output_folder, img_path.split('/')[-1]), trimap_out)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -55,6 +44,7 @@ if __name__ == '__main__':
     parser.add_argument('--checkpoint', type=str, default='BEST_checkkpoint.tar')
     parser.add_argument('--output-folder', type=str)
     parser.add_argument('--device', type=str)
+    parser.add_argument('--batch-size', type=int, default=8)
     args = parser.parse_args()
     ensure_folder('images' )
     ensure_folder('images/test' )
@@ -70,7 +60,8 @@ if __name__ == '__main__':
     model_state_dict = checkpoint['model_state_dict']
     model = Model('train_trimap').to(device)
     model.load_state_dict(model_state_dict)
-    val_loader  = DataLoader(HADataset('valid'), batch_size=1, shuffle=False, num_workers=2)
+    val_loader  = DataLoader(HADataset('valid'), batch_size=args.batch_size, shuffle=False, num_workers=2,
+                             collate_fn=collate_padded)
     val(val_loader, model)
 
         
@@ -0,0 +1,35 @@
+import math
+import os
+import sys
+
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import bg_window
+
+
+def resize_then_crop(bg, w, h):
+    # the path bg_window replaced: upscale the whole background, then crop
+    bh, bw = bg.shape[:2]
+    ratio = max(w / bw, h / bh)
+    rw, rh = math.ceil(bw * ratio), math.ceil(bh * ratio)
+    bg = cv.resize(bg, (rw, rh), interpolation=cv.INTER_CUBIC)
+    x = np.random.randint(0, rw - w) if rw > w else 0
+    y = np.random.randint(0, rh - h) if rh > h else 0
+    return bg[y:y + h, x:x + w]
+
+
+def test_bg_window_approximates_resize_then_crop():
+    rng = np.random.RandomState(0)
+    bg = cv.GaussianBlur(rng.randint(0, 256, (300, 400, 3)).astype(np.uint8), (5, 5), 0)
+    w, h = 900, 700
+    np.random.seed(1)
+    out = bg_window(bg, w, h).astype(np.int32)
+    np.random.seed(1)
+    expected = resize_then_crop(bg, w, h).astype(np.int32)
+    assert out.shape == expected.shape
+    diff = np.abs(out - expected)
+    assert diff.mean() <= 2
+    assert diff.max() <= 16
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from composite import composite_u8
+
+
+def test_zero_width_window():
+    fg = np.zeros((600, 0, 3), np.uint8)
+    bg = np.zeros((600, 0, 3), np.uint8)
+    a = np.zeros((600, 0), np.uint8)
+    assert composite_u8(fg, bg, a).shape == (600, 0, 3)
+
+
+def test_non_square_matches_float_blend():
+    rng = np.random.RandomState(0)
+    fg = rng.randint(0, 256, (150, 60, 3)).astype(np.uint8)
+    bg = rng.randint(0, 256, (150, 60, 3)).astype(np.uint8)
+    a = rng.randint(0, 256, (150, 60)).astype(np.uint8)
+    expected = (a[..., None].astype(np.int64) * fg + (255 - a[..., None].astype(np.int64)) * bg) // 255
+    assert np.array_equal(composite_u8(fg, bg, a), expected)
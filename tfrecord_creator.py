@@ -1,11 +1,22 @@
+import argparse
+import hashlib
+import json
+import math
 import os
+import struct
+from functools import partial
+from multiprocessing import Pool, cpu_count
 
-import tensorflow as tf 
-from tensorflow.keras.preprocessing import image 
+import cv2 as cv
+import numpy as np
+
+from tfrecord_reader import masked_crc, index_filename, build_shard_index
 
 # tf.enable_eager_execution()
 
 def read_sample(serialized_example):
+    import tensorflow as tf
+
     feature_extraction = {
         'image': tf.io.FixedLenFeature([], tf.string),
         'height': tf.io.FixedLenFeature([], tf.int64),
@@ -16,6 +27,8 @@ def read_sample(serialized_example):
     return example
 
 def read(types="bg", tfrecord_dir=""):
+    import tensorflow as tf
+
     filenames = []
     for filename in os.listdir(tfrecord_dir):
         if types in filename:
@@ -24,22 +37,157 @@ def read(types="bg", tfrecord_dir=""):
     parsed_dataset = raw_dataset.map(read_sample)
     return parsed_dataset
 
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        b = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _field(number, payload):
+    # length-delimited protobuf field
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _bytes_feature(value):
+    return _field(1, _field(1, value))
+
+
+def _int64_feature(value):
+    return _field(3, _field(1, _varint(value)))
+
+
+def serialize_example(features):
+    """
+    Encodes {key: bytes or int} as a tf.train.Example without TensorFlow.
+    """
+    entries = b''
+    for key, value in features.items():
+        feature = _bytes_feature(value) if isinstance(value, bytes) else _int64_feature(value)
+        entries += _field(1, _field(1, key.encode('utf-8')) + _field(2, feature))
+    return _field(1, entries)
+
+
+def write_record(f, data):
+    length = struct.pack('<Q', len(data))
+    f.write(length)
+    f.write(struct.pack('<I', masked_crc(length)))
+    f.write(data)
+    f.write(struct.pack('<I', masked_crc(data)))
+
+
+def image_features(filename, channels, raw=False, max_size=None):
+    """
+    'encoded' keeps the original file bytes; 'raw' stores the decoded uint8 pixels
+    (RGB, or one channel for alpha), optionally downscaled so that the longer
+    side is at most max_size, so readers can skip decoding entirely.
+    """
+    with open(filename, 'rb') as f:
+        image_string = f.read()
+    flag = cv.IMREAD_GRAYSCALE if channels == 1 else cv.IMREAD_COLOR
+    image = cv.imdecode(np.frombuffer(image_string, np.uint8), flag if raw else cv.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError('cannot decode {}'.format(filename))
+    if not raw:
+        depth = image.shape[2] if image.ndim == 3 else 1
+        return {'image': image_string, 'height': image.shape[0], 'width': image.shape[1], 'depth': depth}
+
+    h, w = image.shape[:2]
+    if max_size is not None and max(h, w) > max_size:
+        scale = max_size / max(h, w)
+        image = cv.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv.INTER_AREA)
+    if channels == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    image = np.ascontiguousarray(image)
+    return {'image': image.tobytes(), 'height': image.shape[0], 'width': image.shape[1], 'depth': channels,
+            'format': b'raw'}
+
+
+def source_hash(filenames, raw, max_size):
+    h = hashlib.sha1(json.dumps([raw, max_size]).encode('utf-8'))
+    for filename in filenames:
+        h.update(filename.encode('utf-8'))
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def write_shard(task, channels, raw=False, max_size=None):
+    """
+    Writes one shard unless the hash of its source files matches the manifest.
+    Returns (shard, hash, written).
+    """
+    shard, filenames, old_hash = task
+    digest = source_hash(filenames, raw, max_size)
+    if digest == old_hash and os.path.exists(shard):
+        return shard, digest, False
+
+    tmp_shard = shard + '.part'
+    with open(tmp_shard, 'wb') as f:
+        for filename in filenames:
+            write_record(f, serialize_example(image_features(filename, channels, raw, max_size)))
+    os.replace(tmp_shard, shard)
+    np.save(index_filename(shard), build_shard_index(shard))
+    return shard, digest, True
+
+
+def write(type, names, dirr, tfrecord_dir, num_images_per_shards=2000, raw=False, max_size=None, processes=None):
+    """
+    Shards `names` into '<type>_<index>.tfrecord' files in parallel. Shard contents
+    only depend on their position in `names`, so appending images rewrites the
+    last shard and adds new ones while the others are skipped by hash.
+    """
+    if not os.path.exists(tfrecord_dir):
+        os.makedirs(tfrecord_dir)
+    manifest_filename = os.path.join(tfrecord_dir, '{}_manifest.json'.format(type))
+    manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+
+    num_shards = math.ceil(len(names) / num_images_per_shards)
+    tasks = []
+    for i in range(num_shards):
+        shard = os.path.join(tfrecord_dir, '%s_%05d.tfrecord' % (type, i))
+        filenames = [dirr + name for name in names[i * num_images_per_shards:(i + 1) * num_images_per_shards]]
+        tasks.append((shard, filenames, manifest.get(os.path.basename(shard))))
+
+    channels = 1 if type == 'a' else 3
+    worker = partial(write_shard, channels=channels, raw=raw, max_size=max_size)
+    new_manifest = {}
+    written = 0
+    with Pool(processes=processes or cpu_count()) as p:
+        for shard, digest, shard_written in p.imap_unordered(worker, tasks):
+            new_manifest[os.path.basename(shard)] = digest
+            written += shard_written
+    print('{}: {} of {} shards written'.format(type, written, num_shards))
+
+    # shards beyond the new count are left over from a longer name list
+    for name in set(manifest) - set(new_manifest):
+        for filename in [os.path.join(tfrecord_dir, name), index_filename(os.path.join(tfrecord_dir, name))]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    with open(manifest_filename, 'w') as f:
+        json.dump(new_manifest, f, indent=1, sort_keys=True)
+
+
 if __name__ == "__main__":
-    tfrecord_dir="data/tfrecord1/"
-    def _bytes_feature(value):
-        """Returns a bytes_list from a string / byte."""
-        # If the value is an eager tensor BytesList won't unpack a string from an EagerTensor.
-        if isinstance(value, type(tf.constant(0))):
-            value = value.numpy() 
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-    def _float_feature(value):
-        """Returns a float_list from a float / double."""
-        return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
-
-    def _int64_feature(value):
-        """Returns an int64_list from a bool / enum / int / uint."""
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+    parser = argparse.ArgumentParser(description='Write fg/bg/alpha images to TFRecord shards')
+    parser.add_argument('--tfrecord-dir', type=str, default='data/tfrecord/')
+    parser.add_argument('--split', default='all', choices=['train', 'test', 'all'])
+    parser.add_argument('--types', nargs='+', default=['bg', 'a', 'fg'])
+    parser.add_argument('--images-per-shard', type=int, default=2000)
+    parser.add_argument('--raw', action='store_true', help='store decoded uint8 pixels instead of file bytes')
+    parser.add_argument('--max-size', type=int, default=None, help='downscale raw images to this longer side')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
 
     fg_dir = 'data/fg/'
     bg_dir = 'data/bg/'
@@ -48,19 +196,6 @@ if __name__ == "__main__":
     test_bg_dir = 'data/bg_test/'
     test_a_dir  = 'data/mask_test/'
 
-    def serialize(image):
-        shape = tf.image.decode_jpeg(image).shape
-        feature = {
-            'image': _bytes_feature(image),
-            'height': _int64_feature(shape[0]),
-            'width': _int64_feature(shape[1]),
-            'depth': _int64_feature(shape[2])
-        }
-        example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
-        return example_proto
-
-    # with open("./../train_names.txt") as f:
-    #     names = f.read().splitlines()
     with open("data/Combined_Dataset/Training_set/training_bg_names.txt") as f:
         bg_names = f.read().splitlines()
     with open("data/Combined_Dataset/Training_set/training_fg_names.txt") as f:
@@ -70,49 +205,13 @@ if __name__ == "__main__":
     with open("data/Combined_Dataset/Test_set/test_fg_names.txt") as f:
         test_fg_names = f.read().splitlines()
 
-    def write(type="bg"):
-        if type == 'bg':
-            names = bg_names
-            dirr = bg_dir
-            test_names = test_bg_names
-            test_dirr = test_bg_dir
-        elif type == 'fg':
-            names = fg_names
-            dirr = fg_dir
-            test_names = test_fg_names
-            test_dirr = test_fg_dir
-        else:
-            names = fg_names
-            dirr = a_dir 
-            test_names = test_fg_names
-            test_dirr = test_a_dir
-
-        num_images_per_shards = 2000
-        num_shards = len(test_names) // num_images_per_shards + 1
-        for i in range(0, len(test_names), num_images_per_shards):
-            tfrecord_name = 'test_%s_%05d-of-%05d.tfrecord' % (type, i // 200, num_shards)
-            with tf.io.TFRecordWriter(tfrecord_dir + tfrecord_name) as writer:
-                tfrecord_sample_names = test_names[i:i+num_images_per_shards]
-                for tfrecord_sample_name in tfrecord_sample_names:
-                    print(test_dirr+tfrecord_sample_name)
-                    image_string = open(test_dirr+tfrecord_sample_name, "rb").read()
-                    # print(image_string)
-                    tf_example = serialize(image_string)
-                    writer.write(tf_example.SerializeToString())
-
-        # num_images_per_shards = 2000
-        # num_shards = len(names) // num_images_per_shards + 1
-        # for i in range(0, len(names), num_images_per_shards):
-        #     tfrecord_name = '%s_%05d-of-%05d.tfrecord' % (type, i // 200, num_shards)
-        #     with tf.io.TFRecordWriter(tfrecord_dir + tfrecord_name) as writer:
-        #         tfrecord_sample_names = names[i:i+num_images_per_shards]
-        #         for tfrecord_sample_name in tfrecord_sample_names:
-        #             print(dirr+tfrecord_sample_name)
-        #             image_string = open(dirr+tfrecord_sample_name, "rb").read()
-        #             # print(image_string)
-        #             tf_example = serialize(image_string)
-        #             writer.write(tf_example.SerializeToString())
-
-    write("bg")
-    write("a")
-    write("fg")
+    sources = {
+        'train': {'bg': (bg_names, bg_dir), 'fg': (fg_names, fg_dir), 'a': (fg_names, a_dir)},
+        'test': {'bg': (test_bg_names, test_bg_dir), 'fg': (test_fg_names, test_fg_dir), 'a': (test_fg_names, test_a_dir)},
+    }
+    splits = ['train', 'test'] if args.split == 'all' else [args.split]
+    for split in splits:
+        for type in args.types:
+            names, dirr = sources[split][type]
+            write(type, names, dirr, os.path.join(args.tfrecord_dir, split), args.images_per_shard,
+                  args.raw, args.max_size, args.processes)
@@ -0,0 +1,409 @@
+import atexit
+import logging
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2 as cv
+import numpy as np
+
+# Pure Python/NumPy reader for the shards written by tfrecord_creator.py, so that
+# DataLoader workers never have to import TensorFlow just to read bytes.
+try:
+    from crc32c import crc32c
+except ImportError:
+    try:
+        from google_crc32c import value as crc32c
+    except ImportError:
+        crc32c = None
+
+logger = logging.getLogger(__name__)
+
+# A TFRecord is: uint64 length, uint32 masked crc32c(length), data, uint32 masked crc32c(data)
+header_size = 12
+footer_size = 4
+
+
+def shard_filenames(types="bg", tfrecord_dir=""):
+    filenames = []
+    for filename in sorted(os.listdir(tfrecord_dir)):
+        if types in filename and filename.endswith('.tfrecord'):
+            filenames.append(os.path.join(tfrecord_dir, filename))
+    return filenames
+
+
+def index_filename(shard):
+    return shard + '.index.npy'
+
+
+def build_shard_index(shard):
+    """
+    Scans the record headers of one shard and returns an int64 array of
+    (data offset, data length) rows. Only the 12-byte headers are read.
+    """
+    rows = []
+    size = os.path.getsize(shard)
+    with open(shard, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(header_size)
+            if len(header) < header_size:
+                raise IOError('truncated record header in {} at {}'.format(shard, offset))
+            length, = struct.unpack('<Q', header[:8])
+            rows.append((offset + header_size, length))
+            offset += header_size + length + footer_size
+    return np.array(rows, np.int64).reshape(-1, 2)
+
+
+def load_shard_index(shard):
+    # the index is built once and stored next to the shard
+    filename = index_filename(shard)
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(shard):
+        return np.load(filename)
+    index = build_shard_index(shard)
+    np.save(filename, index)
+    return index
+
+
+_crc32c_table = []
+for _n in range(256):
+    _c = _n
+    for _k in range(8):
+        _c = (_c >> 1) ^ 0x82F63B78 if _c & 1 else _c >> 1
+    _crc32c_table.append(_c)
+
+
+def _crc32c_python(data):
+    crc = 0xFFFFFFFF
+    table = _crc32c_table
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+_crc_warned = False
+
+
+def resolve_check_crc(check_crc=None):
+    """
+    None verifies checksums only when the fast crc32c implementation is installed;
+    True forces the check, with the slow pure Python CRC if need be.
+    """
+    global _crc_warned
+    if crc32c is None and check_crc is not False and not _crc_warned:
+        _crc_warned = True
+        if check_crc is None:
+            logger.warning('crc32c is not installed, TFRecord checksums are not verified '
+                           '(pip install crc32c)')
+        else:
+            logger.warning('crc32c is not installed, TFRecord checksums use a slow pure Python CRC '
+                           '(pip install crc32c)')
+    return crc32c is not None if check_crc is None else bool(check_crc)
+
+
+def masked_crc(data):
+    crc = crc32c(data) if crc32c is not None else _crc32c_python(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def check_record(record, length):
+    # record holds header, data and footer of a single TFRecord
+    length_crc, = struct.unpack('<I', record[8:header_size])
+    data_crc, = struct.unpack('<I', record[header_size + length:])
+    if masked_crc(record[:8]) != length_crc or masked_crc(record[header_size:header_size + length]) != data_crc:
+        raise IOError('corrupted TFRecord')
+
+
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf, start, end):
+    # yields (field number, wire type, value or (begin, end) of the payload)
+    pos = start
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+            yield field, wire, value
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            yield field, wire, (pos, pos + length)
+            pos += length
+        elif wire == 1:
+            yield field, wire, (pos, pos + 8)
+            pos += 8
+        elif wire == 5:
+            yield field, wire, (pos, pos + 4)
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire))
+
+
+def _to_int64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _parse_feature(buf, start, end):
+    values = []
+    for kind, _, (begin, stop) in _fields(buf, start, end):
+        for field, wire, value in _fields(buf, begin, stop):
+            if field != 1:
+                continue
+            if kind == 1:
+                # BytesList: zero-copy view into the record
+                values.append(buf[value[0]:value[1]])
+            elif kind == 2:
+                values.extend(np.frombuffer(buf[value[0]:value[1]], '<f4').tolist())
+            elif kind == 3 and wire == 0:
+                values.append(_to_int64(value))
+            elif kind == 3:
+                pos, stop_ = value
+                while pos < stop_:
+                    v, pos = _varint(buf, pos)
+                    values.append(_to_int64(v))
+    return values[0] if len(values) == 1 else values
+
+
+def parse_example(serialized):
+    """
+    Parses a serialized tf.train.Example into {key: value}. Single element
+    features are unwrapped like tf.io.FixedLenFeature([]); bytes come back as
+    memoryview slices of `serialized`.
+    """
+    buf = memoryview(serialized)
+    example = {}
+    for field, _, (begin, end) in _fields(buf, 0, len(buf)):
+        if field != 1:
+            continue
+        for entry_field, _, (entry_begin, entry_end) in _fields(buf, begin, end):
+            if entry_field != 1:
+                continue
+            key = None
+            feature = None
+            for kv_field, _, span in _fields(buf, entry_begin, entry_end):
+                if kv_field == 1:
+                    key = bytes(buf[span[0]:span[1]]).decode('utf-8')
+                elif kv_field == 2:
+                    feature = span
+            if key is not None and feature is not None:
+                example[key] = _parse_feature(buf, *feature)
+    return example
+
+
+def decode_image(features, channels=3):
+    """
+    Decodes the 'image' feature with OpenCV. Colour images are returned as RGB
+    (h, w, 3) and alpha mattes as (h, w, 1), the same layout tf.image.decode_jpeg gave.
+    Records written with tfrecord_creator --raw already hold those pixels and are
+    returned as read-only views without decoding.
+    """
+    buf = np.frombuffer(features['image'], np.uint8)
+    if bytes(features.get('format', b'')) == b'raw':
+        return buf.reshape(features['height'], features['width'], features['depth'])
+    if channels == 1:
+        return cv.imdecode(buf, cv.IMREAD_GRAYSCALE)[:, :, None]
+    img = cv.imdecode(buf, cv.IMREAD_COLOR)
+    return cv.cvtColor(img, cv.COLOR_BGR2RGB)
+
+
+def iter_shard(shard, check_crc=None, buffer_size=1 << 22):
+    """
+    Sequential scan of one shard with large buffered reads, yielding the data of
+    every record in file order. See resolve_check_crc for check_crc.
+    """
+    check_crc = resolve_check_crc(check_crc)
+    with open(shard, 'rb', buffering=buffer_size) as f:
+        while True:
+            header = f.read(header_size)
+            if not header:
+                return
+            if len(header) < header_size:
+                raise IOError('truncated record header in {}'.format(shard))
+            length, = struct.unpack('<Q', header[:8])
+            rest = f.read(length + footer_size)
+            if check_crc:
+                check_record(header + rest, length)
+            yield memoryview(rest)[:length]
+
+
+def shuffle_buffer(iterable, size, rng=np.random):
+    # bounded shuffle: keep `size` items and emit a random one as each new item arrives
+    buf = []
+    for item in iterable:
+        if len(buf) < size:
+            buf.append(item)
+            continue
+        j = rng.randint(size)
+        yield buf[j]
+        buf[j] = item
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
+
+def load_shard_sizes(shard):
+    """
+    int32 (height, width) of every record of a shard, cached next to it.
+    """
+    filename = shard + '.sizes.npy'
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(shard):
+        return np.load(filename)
+    sizes = []
+    for record in iter_shard(shard, check_crc=False):
+        features = parse_example(record)
+        sizes.append((features['height'], features['width']))
+    sizes = np.array(sizes, np.int32).reshape(-1, 2)
+    np.save(filename, sizes)
+    return sizes
+
+
+class RandomAccessReader(object):
+    """
+    Random access over every record of the shards matching `types`. Records are
+    located through the per-shard offset index and read with a single seek, so
+    nothing is kept in memory but the (shard, offset, length) table.
+    """
+
+    def __init__(self, types="bg", tfrecord_dir="", check_crc=None):
+        # check_crc: verify every record read, by default when crc32c is installed
+        self.types = types
+        self.tfrecord_dir = tfrecord_dir
+        self.check_crc = resolve_check_crc(check_crc)
+        self._index = None
+        self._files = {}
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_pid'] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.shards = shard_filenames(self.types, self.tfrecord_dir)
+            tables = []
+            for shard_id, shard in enumerate(self.shards):
+                shard_index = load_shard_index(shard)
+                shard_ids = np.full((len(shard_index), 1), shard_id, np.int64)
+                tables.append(np.hstack([shard_ids, shard_index]))
+            self._index = np.concatenate(tables) if tables else np.zeros((0, 3), np.int64)
+        return self._index
+
+    def _file(self, shard_id):
+        # file handles are never shared with a forked DataLoader worker
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if shard_id not in self._files:
+            self._files[shard_id] = open(self.shards[shard_id], 'rb')
+        return self._files[shard_id]
+
+    def __len__(self):
+        return len(self.index)
+
+    def sizes(self):
+        # (height, width) per record, in the same order as the index
+        self.index
+        tables = [load_shard_sizes(shard) for shard in self.shards]
+        return np.concatenate(tables) if tables else np.zeros((0, 2), np.int32)
+
+    def read_record(self, i):
+        shard_id, offset, length = (int(v) for v in self.index[i])
+        f = self._file(shard_id)
+        if not self.check_crc:
+            f.seek(offset)
+            return f.read(length)
+        f.seek(offset - header_size)
+        record = f.read(header_size + length + footer_size)
+        check_record(record, length)
+        return memoryview(record)[header_size:header_size + length]
+
+    def __getitem__(self, i):
+        return parse_example(self.read_record(i))
+
+
+def _attach(name):
+    # Only the owner keeps the segment registered with the resource tracker, which
+    # unlinks it if the owner dies. Before Python 3.13 attaching registers it again,
+    # and the tracker is shared with the workers, so registration is skipped there.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedRecordPool(object):
+    """
+    Every record of the shards matching `types`, still encoded, packed into one
+    shared memory segment with int64 offsets. Build it once in the main process
+    and pass it to the datasets: DataLoader workers (forked, or unpickled by name)
+    read the same pages, so host RAM holds a single copy of the pool however many
+    workers run. The creating process unlinks it at exit.
+    """
+
+    def __init__(self, types="bg", tfrecord_dir="", check_crc=None):
+        check_crc = resolve_check_crc(check_crc)
+        self.types = types
+        self.tfrecord_dir = tfrecord_dir
+        self.shards = shard_filenames(types, tfrecord_dir)
+        lengths = [int(length) for shard in self.shards for _, length in load_shard_index(shard)]
+        self.offsets = np.zeros(len(lengths) + 1, np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(self.offsets[-1])))
+        i = 0
+        for shard in self.shards:
+            for record in iter_shard(shard, check_crc):
+                self.shm.buf[self.offsets[i]:self.offsets[i + 1]] = record
+                i += 1
+        self.name = self.shm.name
+        self._owner = os.getpid()
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['shm']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = _attach(self.name)
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.shm.close()
+        if self._owner == os.getpid():
+            self.shm.unlink()
+        self.shm = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sizes(self):
+        tables = [load_shard_sizes(shard) for shard in self.shards]
+        return np.concatenate(tables) if tables else np.zeros((0, 2), np.int32)
+
+    def read_record(self, i):
+        return self.shm.buf[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i):
+        return parse_example(self.read_record(i))
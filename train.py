@@ -5,6 +5,7 @@ import random
 import torch
 import torchvision
 from torchsummary import summary
+from torch.utils.data import Subset
 from torch.utils.data.dataloader import DataLoader
 import torch.nn.functional as F
 import torch.optim as optim
@@ -12,15 +13,44 @@ import numpy as np
 from tensorboardX import SummaryWriter
 from torch.cuda.amp import autocast, GradScaler
 
-from utils import parse_args, save_checkpoint, AverageMeter, clip_gradient, get_logger, get_learning_rate
-from config import device, im_size, grad_clip, print_freq
+from utils import parse_args, CheckpointWriter, AverageMeter, clip_gradient, get_logger, get_learning_rate, \
+    stratified_subset, bootstrap_ci
+from config import device, im_size, grad_clip, print_freq, bg_tfrecord_dir
 from model import Model
-from data_human import HADataset
+from data_human import HADataset, HAStreamDataset
+from tfrecord_reader import RandomAccessReader, SharedRecordPool
+from valid_store import HAValidStore
 from loss import LossFunction
+from augment import ImageTransform, gen_trimap_batch
+from evaluation import evaluate, collate_padded
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print('Using device {}'.format(device))
 
+# used when the datasets emit uint8 batches (--uint8-batches)
+batch_transforms = {
+    'train': ImageTransform('train'),
+    'valid': ImageTransform('valid'),
+}
+
+
+def to_device(img, alpha_label, trimap_label, split):
+    if img.dtype == torch.uint8:
+        # one fused conversion + augmentation + normalization on the target device
+        img = batch_transforms[split](img.to(device, non_blocking=True))
+        alpha_label = alpha_label.to(device, non_blocking=True).float().div_(255)
+    else:
+        img = img.type(torch.FloatTensor).to(device)  # [N, 4, 320, 320]
+        alpha_label = alpha_label.type(
+            torch.FloatTensor).to(device)  # [N, 320, 320]
+    alpha_label = alpha_label.unsqueeze(1)
+    if trimap_label.numel() == 0:
+        # dataset built with gen_trimap=True: synthesize the whole batch at once
+        trimap_label = gen_trimap_batch(alpha_label)
+    else:
+        trimap_label = trimap_label.to(device, non_blocking=True)
+    return img, alpha_label, trimap_label
+
 
 def train(train_loader, model, optimizer, epoch, logger):
     model.train()  # train mode (dropout and batchnorm is used)
@@ -33,11 +63,7 @@ def train(train_loader, model, optimizer, epoch, logger):
     # Batches
     for i, (img, alpha_label, trimap_label, _) in enumerate(train_loader):
         # Move to GPU, if available
-        img = img.type(torch.FloatTensor).to(device)  # [N, 4, 320, 320]
-        alpha_label = alpha_label.type(
-            torch.FloatTensor).to(device)  # [N, 320, 320]
-        alpha_label = alpha_label.unsqueeze(1)
-        trimap_label = trimap_label.to(device)
+        img, alpha_label, trimap_label = to_device(img, alpha_label, trimap_label, 'train')
         # alpha_label = alpha_label.reshape((-1, 2, im_size * im_size))  # [N, 320*320]
         with autocast():
             # Forward prop.
@@ -79,37 +105,30 @@ def train(train_loader, model, optimizer, epoch, logger):
     # save_checkpoint(epoch, 0, model, optimizer, losses.avg, False, args.checkpoint_dir)
     return losses.avg
 
-def val(val_loader, model, optimizer, epoch, logger):
-    model.val()
+def val(val_loader, model, optimizer, epoch, logger, tag='Val_Loss', values=None):
+    # values: optional list receiving the loss of every sample
     losses = AverageMeter()
     # loss_function = alpha_prediction_loss
     criterion = LossFunction(args.stage)()
-    
-    # Batches
-    for i, (img, alpha_label, trimap_label, _) in enumerate(val_loader):
-        # Move to GPU, if available
-        img = img.type(torch.FloatTensor).to(device)  # [N, 4, 320, 320]
-        alpha_label = alpha_label.type(
-            torch.FloatTensor).to(device)  # [N, 320, 320]
-        alpha_label = alpha_label.unsqueeze(1)
-        trimap_label = trimap_label.to(device)
-        # Forward prop.
-        trimap_out, alpha_out = model(img)  # [N, 3, 320, 320]
-        # alpha_out = alpha_out.reshape((-1, 1, im_size * im_size))  # [N, 320*320]
+    num_samples = len(val_loader.dataset)
 
+    # Batches of padded samples, results come back one sample at a time
+    for i, out in enumerate(evaluate(model, val_loader, device)):
         # Calculate loss
         if args.stage == 'train_trimap':
-            loss = criterion(trimap_out, trimap_label)
+            loss = criterion(out['trimap_out'], out['trimap'])
         elif args.stage == 'train_alpha':
-            loss = criterion(alpha_out, alpha_label, trimap_out, trimap_label)
+            loss = criterion(out['alpha_out'], out['alpha'], out['trimap_out'], out['trimap'])
 
         losses.update(loss.item())
+        if values is not None:
+            values.append(loss.item())
         if i % print_freq == 0:
             status = 'Epoch: [{0}][{1}/{2}]\t' \
                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                         epoch, i, len(val_loader), loss=losses)
+                         epoch, i, num_samples, loss=losses)
             logger.info(status)
-    writer.add_scalar('Val_Loss', losses.avg, epoch)
+    writer.add_scalar(tag, losses.avg, epoch)
     writer.add_scalar('Learning_Rate', get_learning_rate(optimizer), epoch)
     return losses.avg
 
@@ -167,19 +186,75 @@ if __name__ == '__main__':
         else:
             random.setstate(42)
     summary(model, (3, 320, 320), depth=6)
+    # built once here; forked or spawned workers attach to the same shared memory
+    if args.shared_bg:
+        backgrounds = SharedRecordPool("bg", bg_tfrecord_dir, args.check_crc)
+    else:
+        backgrounds = RandomAccessReader("bg", bg_tfrecord_dir, args.check_crc)
+    train_options = dict(raw=args.uint8_batches, gen_trimap=args.gen_trimap, trace_dir=args.trace_dir,
+                         size_aware_bg=args.size_aware_bg, backgrounds=backgrounds)
+    if args.stream_bg:
+        train_set = HAStreamDataset('train', check_crc=args.check_crc, **train_options)
+    else:
+        train_set = HADataset('train', **train_options)
+    # an IterableDataset shuffles itself
     train_loader = DataLoader(
-        HADataset('train'), batch_size=args.batch_size, shuffle=True, pin_memory=True, num_workers=8)
-    val_loader  = DataLoader(HADataset('valid'), batch_size=1, shuffle=False, num_workers=2)
+        train_set, batch_size=args.batch_size, shuffle=not args.stream_bg, pin_memory=True, num_workers=8)
+    if args.valid_store:
+        val_set = HAValidStore(raw=args.uint8_batches)
+    else:
+        val_set = HADataset('valid', raw=args.uint8_batches, backgrounds=backgrounds)
+    val_loader  = DataLoader(val_set, batch_size=args.val_batch_size, shuffle=False, num_workers=2,
+                             collate_fn=collate_padded)
+    fast_val_loader = None
+    if args.fast_val > 0:
+        # strata: groups of --fast-val-group foregrounds, and with the pre-rendered store also
+        # the image size in 160 px steps; every validation portrait is its own foreground
+        meta = getattr(val_set, 'meta', None)
+        if meta is not None:
+            strata = [(f // args.fast_val_group, h // 160, w // 160) for f, h, w in meta.tolist()]
+        else:
+            strata = [(i // args.fast_val_group,) for i in range(len(val_set))]
+        subset = stratified_subset(strata, args.fast_val)
+        fast_val_strata = [strata[i] for i in subset]
+        # stratum weights of the full split, so the subset estimates the full validation loss
+        fast_val_weights = {}
+        for key in strata:
+            fast_val_weights[key] = fast_val_weights.get(key, 0) + 1
+        fast_val_loader = DataLoader(Subset(val_set, subset), batch_size=args.val_batch_size, shuffle=False,
+                                     num_workers=2, collate_fn=collate_padded)
     total_training_time = 0
     n_epochs = args.end_epoch
     logger = get_logger()
+    checkpoint_writer = CheckpointWriter(args.checkpoint_dir, args.keep_checkpoints)
+    best_loss = float('inf')
     for epoch in range(start_epoch, n_epochs + 1):
         start = time()
+        if args.stream_bg:
+            train_set.set_epoch(epoch)
         train_loss = train(train_loader, model, optimizer, epoch, logger)
-        save_checkpoint(epoch, 0, model, optimizer, train_loss, False, args.checkpoint_dir)
+        checkpoint_writer.save(epoch, model, optimizer, train_loss)
         end = time()
         print('\nTraning process takes {} seconds'.format(end - start))
         if (epoch - start_epoch) % 2 == 1:
-            val_loss = val(val_loader, model, optimizer, epoch, logger)
+            if fast_val_loader is not None:
+                values = []
+                val_loss = val(fast_val_loader, model, optimizer, epoch, logger, 'Fast_Val_Loss', values)
+                mean, low, high = bootstrap_ci(values, fast_val_strata, fast_val_weights)
+                logger.info('Fast validation loss {:.4f} (95% CI {:.4f} - {:.4f}, {} samples)'.format(
+                    mean, low, high, len(values)))
+                # the scheduler follows the stratified estimate
+                val_loss = mean
+                writer.add_scalar('Fast_Val_Loss_CI_Low', low, epoch)
+                writer.add_scalar('Fast_Val_Loss_CI_High', high, epoch)
+            else:
+                val_loss = val(val_loader, model, optimizer, epoch, logger)
             scheduler.step(val_loss)
+            if val_loss < best_loss:
+                best_loss = val_loss
+                checkpoint_writer.mark_best()
+        if fast_val_loader is not None and epoch % args.full_val_every == 0:
+            val(val_loader, model, optimizer, epoch, logger)
         total_training_time += end - start
+    # flush the last checkpoint before exiting
+    checkpoint_writer.wait()
@@ -0,0 +1,59 @@
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+
+from config import a_path, unknown_index_path
+
+
+def build_unknown_index(fg_files, filename=unknown_index_path, max_points=65536, seed=0):
+    """
+    Stores the (row, col) of the unknown pixels (0 < alpha < 255) of every alpha as
+    one flat uint16 array, with int64 offsets delimiting each foreground. Mattes with
+    more than max_points unknown pixels keep a uniform random subset of them.
+    """
+    rng = np.random.RandomState(seed)
+    offsets = np.zeros(len(fg_files) + 1, np.int64)
+    shapes = np.zeros((len(fg_files), 2), np.int32)
+    coords = []
+    for i, name in enumerate(tqdm(fg_files)):
+        a = cv.imread(a_path + name, 0)
+        shapes[i] = a.shape[:2]
+        points = np.argwhere((a > 0) & (a < 255)).astype(np.uint16)
+        if len(points) > max_points:
+            points = points[np.sort(rng.choice(len(points), max_points, replace=False))]
+        coords.append(points)
+        offsets[i + 1] = offsets[i] + len(points)
+    coords = np.concatenate(coords) if coords else np.zeros((0, 2), np.uint16)
+    np.savez(filename, coords=coords.reshape(-1, 2), offsets=offsets, shapes=shapes)
+
+
+class UnknownIndex(object):
+    def __init__(self, filename=unknown_index_path):
+        with np.load(filename) as index:
+            self.coords = index['coords']
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+
+    def count(self, fcount):
+        return int(self.offsets[fcount + 1] - self.offsets[fcount])
+
+    def sample(self, fcount, shape=None):
+        """
+        A random unknown pixel of foreground fcount, or None if its matte has none.
+        :param shape: (h, w) the foreground is read at, if it differs from the indexed alpha
+        :return: (row, col)
+        """
+        begin, end = int(self.offsets[fcount]), int(self.offsets[fcount + 1])
+        if end == begin:
+            return None
+        row, col = (int(v) for v in self.coords[np.random.randint(begin, end)])
+        if shape is not None:
+            h, w = self.shapes[fcount]
+            row, col = int(row * shape[0] / h), int(col * shape[1] / w)
+        return row, col
+
+
+if __name__ == '__main__':
+    from data import fg_files
+
+    build_unknown_index(fg_files)
@@ -1,7 +1,10 @@
 import argparse
 import logging
+import math
 import os
 import random
+import shutil
+import threading
 
 import cv2 as cv
 import numpy as np
@@ -32,25 +35,121 @@ def clip_gradient(optimizer, grad_clip):
                 param.grad.data.clamp_(-grad_clip, grad_clip)
 
 
+def _to_cpu(obj):
+    # detached CPU copies of every tensor, so training can go on while they are written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def checkpoint_state(epoch, model, optimizer, loss):
+    return {'epoch': epoch,
+            #  'epochs_since_improvement': epochs_since_improvement,
+            'loss': loss,
+            'model_state_dict': _to_cpu(model.state_dict()),
+            'optimizer_state_dict': _to_cpu(optimizer.state_dict()),
+            'torch_seed': torch.get_rng_state(),
+            # None on CPU-only hosts, train.py then seeds CUDA itself when resuming
+            'torch_cuda_seed': torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+            'np_seed': np.random.get_state(),
+            'seed': random.getstate(),
+            }
+
+
+def write_checkpoint(state, filename):
+    # write to a temporary file and rename, so a crash never leaves a truncated checkpoint
+    tmp = filename + '.part'
+    torch.save(state, tmp)
+    os.replace(tmp, filename)
+
+
+def link_best(filename, checkpoint_dir):
+    # BEST_checkpoint.tar is a hard link to the checkpoint, not a second copy
+    best = os.path.join(checkpoint_dir, 'BEST_checkpoint.tar')
+    tmp = best + '.part'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(filename, tmp)
+    except OSError:
+        shutil.copyfile(filename, tmp)
+    os.replace(tmp, best)
+
+
 def save_checkpoint(epoch, epochs_since_improvement, model, optimizer, loss, is_best, checkpoint_dir):
-    state = {'epoch': epoch,
-             #  'epochs_since_improvement': epochs_since_improvement,
-             'loss': loss,
-             'model_state_dict': model.state_dict(),
-             'optimizer_state_dict': optimizer.state_dict(),
-             'torch_seed': torch.get_rng_state(),
-             'torch_cuda_seed': torch.cuda.get_rng_state(),
-             'np_seed': np.random.get_state(),
-             'seed': random.getstate(),
-             }
+    state = checkpoint_state(epoch, model, optimizer, loss)
     # filename = 'checkpoint_' + str(epoch) + '_' + str(loss) + '.tar'
     filename = 'checkpoint_{}_{}.tar'.format(epoch, loss)
     ensure_folder(checkpoint_dir)
     filename = os.path.join(checkpoint_dir, filename)
-    torch.save(state, filename)
-    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
+    write_checkpoint(state, filename)
+    # If this checkpoint is the best so far, keep it so it doesn't get overwritten by a worse checkpoint
     if is_best:
-        torch.save(state, os.path.join(checkpoint_dir, 'BEST_checkpoint.tar'))
+        link_best(filename, checkpoint_dir)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread. The state is snapshotted to CPU
+    on the calling thread, so training resumes as soon as save() returns.
+    Only the last keep_last checkpoints are kept, plus BEST_checkpoint.tar.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=3):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+        ensure_folder(checkpoint_dir)
+        # checkpoints of earlier runs count towards keep_last, oldest epoch first
+        self.saved = []
+        for name in os.listdir(checkpoint_dir):
+            if name.startswith('checkpoint_') and name.endswith('.tar'):
+                try:
+                    epoch = int(name[len('checkpoint_'):].split('_')[0])
+                except ValueError:
+                    continue
+                self.saved.append((epoch, os.path.join(checkpoint_dir, name)))
+        self.saved = [filename for _, filename in sorted(self.saved)]
+
+    def save(self, epoch, model, optimizer, loss, is_best=False):
+        state = checkpoint_state(epoch, model, optimizer, loss)
+        filename = os.path.join(self.checkpoint_dir, 'checkpoint_{}_{}.tar'.format(epoch, loss))
+        # at most one write in flight
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, filename, is_best), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, filename, is_best):
+        try:
+            write_checkpoint(state, filename)
+            if is_best:
+                link_best(filename, self.checkpoint_dir)
+            if filename in self.saved:
+                self.saved.remove(filename)
+            self.saved.append(filename)
+            while len(self.saved) > self.keep_last:
+                os.remove(self.saved.pop(0))
+        except Exception as e:
+            self.error = e
+
+    def mark_best(self):
+        # links the most recent checkpoint, e.g. once validation found it the best
+        self.wait()
+        if self.saved:
+            link_best(self.saved[-1], self.checkpoint_dir)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
 
 
 class AverageMeter(object):
@@ -74,6 +173,57 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+def stratified_subset(strata, per_stratum, seed=0):
+    """
+    Fixed subset holding at most per_stratum samples of every stratum.
+    :param strata: one hashable stratum key per sample
+    :return: sorted sample indices
+    """
+    rng = np.random.RandomState(seed)
+    groups = {}
+    for i, key in enumerate(strata):
+        groups.setdefault(key, []).append(i)
+    subset = []
+    for key in sorted(groups, key=str):
+        members = groups[key]
+        if len(members) > per_stratum:
+            members = rng.choice(members, per_stratum, replace=False).tolist()
+        subset.extend(members)
+    return sorted(subset)
+
+
+def bootstrap_ci(values, strata=None, weights=None, num_resamples=1000, confidence=0.95, seed=0):
+    """
+    Percentile bootstrap confidence interval of the mean. With strata, samples are
+    resampled within their stratum and the estimate is the mean of the stratum
+    means weighted by `weights` (e.g. the stratum sizes of the full set).
+    :param strata: optional stratum key of every value
+    :param weights: optional dict of stratum -> weight, default the counts in values
+    :return: mean, lower bound, upper bound
+    """
+    values = np.asarray(values, np.float64)
+    if len(values) == 0:
+        return float('nan'), float('nan'), float('nan')
+    if strata is None:
+        strata = [0] * len(values)
+    groups = {}
+    for value, key in zip(values, strata):
+        groups.setdefault(key, []).append(value)
+    keys = sorted(groups, key=str)
+    w = np.array([(weights or {}).get(key, len(groups[key])) for key in keys], np.float64)
+    w /= w.sum()
+
+    rng = np.random.RandomState(seed)
+    mean = 0.
+    means = np.zeros(num_resamples)
+    for key, wk in zip(keys, w):
+        group = np.asarray(groups[key])
+        mean += wk * group.mean()
+        means += wk * group[rng.randint(len(group), size=(num_resamples, len(group)))].mean(axis=1)
+    low, high = np.percentile(means, [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100])
+    return float(mean), float(low), float(high)
+
+
 def adjust_learning_rate(optimizer, shrink_factor):
     """
     Shrinks learning rate by a specified factor.
@@ -99,7 +249,8 @@ def accuracy(scores, targets, k=1):
     return correct_total.item() * (100.0 / batch_size)
 
 
-def parse_args():
+def parse_args(known_only=False):
+    # known_only: ignore flags of the calling script, for modules parsing at import time
     parser = argparse.ArgumentParser(description='Train face network')
     # general
     parser.add_argument('--end-epoch', type=int,
@@ -130,7 +281,37 @@ def parse_args():
                         default='checkpoint_train_trimap', help='directory to save checkpoint')
     parser.add_argument('--img-root-path', type=str,
                         default='../data', help='root path of image dataset')
-    args = parser.parse_args()
+    parser.add_argument('--uint8-batches', action='store_true',
+                        help='load uint8 batches and normalize them on the device')
+    parser.add_argument('--gen-trimap', action='store_true',
+                        help='generate trimaps per batch from alpha instead of reading trimap files')
+    parser.add_argument('--stream-bg', action='store_true',
+                        help='stream background shards sequentially per worker (HAStreamDataset)')
+    parser.add_argument('--trace-dir', type=str, default=None,
+                        help='record per-sample load latency of the training set here (python profiling.py <dir>)')
+    parser.add_argument('--size-aware-bg', action='store_true',
+                        help='pair foregrounds with backgrounds large enough to need no upscaling')
+    parser.add_argument('--check-crc', action='store_true', default=None,
+                        help='verify TFRecord checksums even without the crc32c package '
+                             '(by default they are verified only when it is installed)')
+    parser.add_argument('--shared-bg', action='store_true',
+                        help='keep the encoded backgrounds in one shared memory pool for all workers')
+    parser.add_argument('--valid-store', action='store_true',
+                        help='validate on the pre-rendered split written by valid_store.py')
+    parser.add_argument('--keep-checkpoints', type=int, default=3,
+                        help='number of most recent checkpoints kept besides BEST_checkpoint.tar')
+    parser.add_argument('--val-batch-size', type=int, default=8,
+                        help='validation batch size, samples are padded to a common size')
+    parser.add_argument('--fast-val', type=int, default=0,
+                        help='validate on at most this many samples per stratum (0: full validation)')
+    parser.add_argument('--fast-val-group', type=int, default=10,
+                        help='with --fast-val, number of consecutive foregrounds forming one stratum')
+    parser.add_argument('--full-val-every', type=int, default=10,
+                        help='with --fast-val, also run a full validation pass every this many epochs')
+    if known_only:
+        args, _ = parser.parse_known_args()
+    else:
+        args = parser.parse_args()
     return args
 
 
@@ -160,6 +341,74 @@ def safe_crop(mat, x, y, crop_size=(im_size, im_size)):
     return ret
 
 
+def bg_window(bg, w, h, roi=None):
+    """
+    Random w x h window of a background upscaled (cubic) to cover a w x h foreground.
+    Approximates cv.resize followed by a random crop: the offsets are drawn the same
+    way, but warpAffine interpolates with fixed-point weights of its own, so pixels
+    differ by about one grey level on average (up to ~8). Only the window, or the
+    (x0, y0, x1, y1) region `roi` of it, is interpolated.
+    """
+    bh, bw = bg.shape[:2]
+    wratio = w / bw
+    hratio = h / bh
+    ratio = wratio if wratio > hratio else hratio
+    if ratio > 1:
+        rw, rh = math.ceil(bw * ratio), math.ceil(bh * ratio)
+    else:
+        rw, rh = bw, bh
+    x = 0
+    if rw > w:
+        x = np.random.randint(0, rw - w)
+    y = 0
+    if rh > h:
+        y = np.random.randint(0, rh - h)
+
+    x0, y0, x1, y1 = roi if roi is not None else (0, 0, w, h)
+    x, y = x + x0, y + y0
+    out_w, out_h = x1 - x0, y1 - y0
+    if ratio <= 1:
+        return bg[y:y + out_h, x:x + out_w]
+    if out_w <= 0 or out_h <= 0:
+        return np.zeros((max(out_h, 0), max(out_w, 0)) + bg.shape[2:], bg.dtype)
+    # cv.resize samples destination pixel d at source coordinate (d + 0.5) / scale - 0.5
+    sx, sy = rw / bw, rh / bh
+    M = np.float32([[1 / sx, 0, (x + 0.5) / sx - 0.5],
+                    [0, 1 / sy, (y + 0.5) / sy - 0.5]])
+    return cv.warpAffine(bg, M, (out_w, out_h), flags=cv.INTER_CUBIC | cv.WARP_INVERSE_MAP,
+                         borderMode=cv.BORDER_REPLICATE)
+
+
+class SizeAwarePairing(object):
+    """
+    Draws backgrounds that already cover a h x w foreground, so bg_window does not
+    have to upscale them. Only backgrounds of the split are drawn, and the listed
+    background is kept whenever it is big enough.
+    :param bg_sizes: int (N, 2) array of background (height, width) for the whole pool
+    :param bg_ids: indices of the backgrounds the split may use, default all of them
+    """
+
+    def __init__(self, bg_sizes, bg_ids=None):
+        bg_sizes = np.asarray(bg_sizes)
+        self.bg_ids = np.arange(len(bg_sizes)) if bg_ids is None else np.unique(np.asarray(bg_ids))
+        self.bg_h = bg_sizes[self.bg_ids, 0]
+        self.bg_w = bg_sizes[self.bg_ids, 1]
+        self.all_h = bg_sizes[:, 0]
+        self.all_w = bg_sizes[:, 1]
+        self.candidates = {}
+
+    def sample(self, h, w, bcount=None):
+        if bcount is not None and self.all_h[bcount] >= h and self.all_w[bcount] >= w:
+            return bcount
+        key = (h, w)
+        if key not in self.candidates:
+            self.candidates[key] = self.bg_ids[(self.bg_h >= h) & (self.bg_w >= w)]
+        candidates = self.candidates[key]
+        if len(candidates) == 0:
+            return bcount if bcount is not None else int(self.bg_ids[np.random.randint(len(self.bg_ids))])
+        return int(candidates[np.random.randint(len(candidates))])
+
+
 def compute_mse(pred, alpha, trimap):
     num_pixels = float((trimap == 128).sum())
     return ((pred - alpha) ** 2).sum() / num_pixels
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.utils.data import Dataset
+
+from config import valid_store_path
+from data_human import HADataset, data_transforms
+from sample_store import SampleStore, write_arrays
+
+
+def build_valid_store(out_dir=valid_store_path, seed=0):
+    """
+    Renders the validation split once, with fixed seeds, into a uint8 sample store:
+    kinds 'image', 'alpha' and 'trimap', plus the image paths and one
+    (portrait index, height, width) row per sample for stratified validation.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    dataset = HADataset('valid', raw=True)
+    paths = []
+    meta = []
+
+    def samples():
+        for i in tqdm(range(len(dataset))):
+            img, alpha, trimap, path = dataset[i]
+            paths.append(path)
+            meta.append((i, img.shape[0], img.shape[1]))
+            yield {'image': img.numpy(), 'alpha': alpha.numpy(), 'trimap': trimap.numpy()}
+
+    write_arrays(samples(), out_dir, extra={'paths': paths, 'meta': meta})
+
+
+class HAValidStore(Dataset):
+    """
+    Reads the store written by build_valid_store, with the same outputs as
+    data_human.HADataset('valid'): every pass sees identical samples.
+    """
+
+    def __init__(self, store_dir=valid_store_path, raw=False):
+        super(HAValidStore, self).__init__()
+        self.store = SampleStore(store_dir)
+        self.paths = self.store.index['paths'].tolist()
+        self.meta = self.store.index['meta']
+        self.raw = raw
+        self.transformer = data_transforms['valid']
+
+    def __getitem__(self, i):
+        # copies, the mapped store is read-only
+        img = np.array(self.store.get('image', i))
+        alpha = np.array(self.store.get('alpha', i))
+        trimap = np.array(self.store.get('trimap', i))
+        if self.raw:
+            return torch.from_numpy(img), torch.from_numpy(alpha), torch.from_numpy(trimap), self.paths[i]
+        return self.transformer(img), alpha / 255.0, trimap, self.paths[i]
+
+    def __len__(self):
+        return self.store.count('image')
+
+
+if __name__ == '__main__':
+    build_valid_store()